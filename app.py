@@ -2,7 +2,8 @@
 Flask application
 
 Endpoints:
-  - /[?league=GL|Remix|UL|ULP|ULRemix|ML|MLC&pokemon=pokemon]
+  - /[?league=GL|Remix|UL|ULP|ULRemix|ML|MLC&pokemon=pokemon][&timing=1]
+  - /metrics (Prometheus text)
 
 TODO:
   - Login with username and keep track of list of pokemon the user doesn't have
@@ -15,12 +16,17 @@ import json
 import os
 import re
 import sys
+import threading
+import time
 import traceback
 
-from flask import Flask, request, render_template, jsonify, redirect, url_for
+from flask import Flask, Response, request, render_template, jsonify, redirect, url_for
 
-from team_building import get_counters_for_rating, LEAGUE_RANKINGS, NoPokemonFound, LEAGUE_VALUE, TeamCreater
-from battle_sim import sim_battle
+from team_building import get_counters_for_rating, LEAGUE_RANKINGS, NoPokemonFound, LEAGUE_VALUE, TeamCreater, warm_leagues
+from battle_sim import battle_trace, sim_battle
+from matchup_matrix import load_matchups
+from game_data import start_background_refresh
+import metrics
 from trampoline import convert_form_data, pretty_print, Practice, current_user, set_current_user,\
      current_event, set_current_event, set_current_athlete, NON_SKILLS
 
@@ -92,6 +98,7 @@ class TableMaker:
     def render(self):
         return "".join(self.table)
 
+@metrics.timed("table")
 def create_table_from_results(results, pokemon=None, width=None, tc=None, tooltip=True):
     """
     Creates an html table from the results.
@@ -111,6 +118,12 @@ def create_table_from_results(results, pokemon=None, width=None, tc=None, toolti
     """
     table = TableMaker(border=1, align="center", bgcolor="#FFFFFF", width=width)
 
+    # Battles are looked up in the league's precomputed matchups and only
+    # simulated when they aren't stored. The battle text is only replayed for tooltips
+    matchups = None
+    if pokemon and tc is not None:
+        matchups = load_matchups(tc.team_maker.league, tc.team_maker.stat_table)
+
     for line in results.split("\n"):
         if not line:
             continue
@@ -137,8 +150,11 @@ def create_table_from_results(results, pokemon=None, width=None, tc=None, toolti
 
                         # simulate battle for text color
                         try:
-                            winner, leftover_health, battle_text = sim_battle(cell_pokemon, pokemon, tc)
-                            tool_tip_text = "&#013;&#010;</br>".join(battle_text)
+                            matchup = matchups.lookup(cell_pokemon, pokemon) if matchups is not None else None
+                            if matchup is None:
+                                matchup = sim_battle(cell_pokemon, pokemon, tc)
+                            winner, leftover_health, _ = matchup
+                            tool_tip_text = "&#013;&#010;</br>".join(battle_trace(cell_pokemon, pokemon, tc)) if tooltip else ""
                             #logger.info(f"winner: {winner} - leftover_health: {leftover_health}")
                         except Exception as exc:
                             winner = None
@@ -166,28 +182,48 @@ def create_table_from_results(results, pokemon=None, width=None, tc=None, toolti
     return table.render()
 
 
+@metrics.timed("teams")
 def make_recommended_teams(team_maker, chosen_pokemon, chosen_league, chosen_position):
     """
     Makes N_TEAMS unique teams
     """
     try:
-        all_team_results = []
-        chosen_teams = []
-        tries = 0
-        while len(chosen_teams) < N_TEAMS and tries < 2*N_TEAMS:
-            tries += 1
-            team_results, pokemon_team = team_maker.recommend_team(chosen_pokemon, position=chosen_position)
-            if pokemon_team in chosen_teams:
-                continue
-            chosen_teams.append(pokemon_team)
-            all_team_results.append(team_results)
-        team_results = "\n".join(all_team_results)
+        if chosen_position == 'best':
+            teams = team_maker.best_teams(N_TEAMS, lead=chosen_pokemon or None)
+        else:
+            teams = team_maker.recommend_teams(N_TEAMS, position=chosen_position, chosen_pokemon=chosen_pokemon)
+        team_results = "\n".join([team_results for team_results, _ in teams])
     except Exception as exc:
         tb = traceback.format_exc()
         team_results = f"Could not create team for {chosen_pokemon} in {chosen_league} because: {exc}.\n{tb}"
     return team_results
 
 
+def timing_footer(timings, total):
+    """
+    Returns an html table of the time spent in each phase of the request
+    """
+    table = TableMaker(border=1, align="center", width="30%")
+    table.new_header("Timing", colspan=3)
+    table.new_row()
+    for value in ["Phase", "Calls", "ms"]:
+        table.add_cell(f"<b>{value}</b>")
+    table.end_row()
+    for name, (calls, seconds) in sorted(timings.items(), key=lambda x: x[1][1], reverse=True):
+        table.new_row()
+        table.add_cell(name)
+        table.add_cell(calls)
+        table.add_cell(f"{seconds*1000:.1f}")
+        table.end_row()
+    table.new_row()
+    table.add_cell("request")
+    table.add_cell(1)
+    table.add_cell(f"{total*1000:.1f}")
+    table.end_row()
+    table.end_table()
+    return table.render()
+
+
 def get_new_data(league, num_days, rating):
     diff_league = CACHE.get("results", {}).get(league) is None
     diff_days = CACHE.get("num_days") != num_days
@@ -381,29 +417,44 @@ def about():
     return render_template("about.html")
 
 
+@app.route("/metrics")
+def prometheus_metrics():
+    """
+    Span timings and cache counters in the Prometheus text format
+    """
+    return Response(metrics.prometheus_text(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/")
 def run():
     global CACHE
     global N_TEAMS
+    request_start = time.perf_counter()
+    metrics.start_request()
     chosen_league = request.args.get("league", "Holiday")
     chosen_pokemon = request.args.get('pokemon', '')
     chosen_position = request.args.get('position', 'lead')
     num_days = int(request.args.get('num_days', '1'))
     rating = eval(request.args.get('rating', "None"))
     use_tooltip = bool(request.args.get('tooltips', False))
+    show_timing = bool(request.args.get('timing', False))
     N_TEAMS = int(request.args.get('num_teams', N_TEAMS))
     html = []
 
     html.append("<h1 align='center'><u>Options</u></h1>")
 
     # Data tables from cache
-    if get_new_data(chosen_league, num_days, rating):
+    new_data = get_new_data(chosen_league, num_days, rating)
+    metrics.count_cache("page", not new_data)
+    if new_data:
+        # Only the days/rating changed for a loaded league: reuse its data
+        cached_team_maker = CACHE['team_maker'].get(chosen_league)
         try:
-            results, team_maker = get_counters_for_rating(rating, chosen_league, days_back=num_days)
+            results, team_maker = get_counters_for_rating(rating, chosen_league, days_back=num_days, team_maker=cached_team_maker)
         except NoPokemonFound as exc:
             error = f"ERROR: Could not get data because: {str(exc)}. Using all data instead"
             html.append(f"<p  style='background-color:yellow;text-align:center'><b>{error}</b></p>")
-            results, team_maker = get_counters_for_rating(None, chosen_league, days_back=None)
+            results, team_maker = get_counters_for_rating(None, chosen_league, days_back=None, team_maker=cached_team_maker)
     else:
         results, team_maker, num_days, rating = CACHE.get('results').get(chosen_league), CACHE.get('team_maker').get(chosen_league), CACHE.get("num_days"), CACHE.get("rating")
     CACHE['results'][chosen_league] = results
@@ -434,8 +485,8 @@ def run():
     pokemon_form.append(f"<input type='hidden' value='{chosen_league}' name='league' />")
     pokemon_form.append(f"<select id='mySelect' name='pokemon'>")
     pokemon_form.append("<option value=''>None</option>")
-    for species in sorted(team_maker.all_pokemon, key=lambda x: x.get('speciesId')):
-        species_name = species.get('speciesId')
+    for species in sorted(team_maker.all_pokemon, key=lambda x: x.species_id):
+        species_name = species.species_id
         if species_name == chosen_pokemon:
             pokemon_form.append(f"<option value='{species_name}' selected>{species_name}</option>")
         else:
@@ -443,6 +494,7 @@ def run():
     pokemon_form.append("</select>")
     pokemon_form.append(f"<br><input type='radio' id='lead' value='lead' name='position'{' checked' if chosen_position=='lead' else ''}><label for='lead'>In the lead</label>")
     pokemon_form.append(f"<br><input type='radio' id='back' value='back' name='position'{' checked' if chosen_position=='back' else ''} ><label for='back'>In the back</label>")
+    pokemon_form.append(f"<br><input type='radio' id='best' value='best' name='position'{' checked' if chosen_position=='best' else ''} ><label for='best'>Best teams (lead optional)</label>")
     options_table.add_cell("".join(pokemon_form))
     options_table.end_row()
     options_table.new_row()
@@ -464,7 +516,7 @@ def run():
     html.extend(["<form action='/'>", options_table.render(), "</form>"])
 
     # Recommended teams
-    #  make N_TEAMS unique teams. But try 2*N_TEAMS times to make unique teams
+    #  make N_TEAMS unique teams
     team_results = make_recommended_teams(team_maker, chosen_pokemon, chosen_league, chosen_position)
 
     html.append("<h1 align='center'><u>Recommended Teams</u></h1>")
@@ -478,8 +530,16 @@ def run():
     html.append(create_table_from_results(results, pokemon=chosen_pokemon, width='75%', tc=tc, tooltip=use_tooltip))
     html.append("</div>")
 
+    timings = metrics.end_request()
+    total = time.perf_counter() - request_start
+    metrics.record_span("request", total)
+    if show_timing:
+        html.append(timing_footer(timings, total))
+
     return render_template("index.html", body="".join(html))
 
     
 if __name__ == "__main__":
+    start_background_refresh()
+    threading.Thread(target=warm_leagues, name="warm-leagues", daemon=True).start()
     app.run(debug=True)
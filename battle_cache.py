@@ -0,0 +1,195 @@
+"""
+Cache of simulated battles
+
+The same battles are simulated again and again across requests and teams.
+Results are cached by everything a battle depends on (the pair, league cp,
+shields, movesets and the gamemaster/stats versions) in two tiers:
+
+  - a bounded in-memory LRU,
+  - an SQLite file that survives restarts (data/battle_cache.sqlite).
+
+Memory hits never wait on the disk: SQLite is only used under its own lock,
+and new results are written in batches. Rows of another cache version are
+deleted when the file is opened, and the table is capped at the most recent
+BATTLE_CACHE_ROWS results so keys of old gamemaster/stats versions age out.
+
+Hits and misses of each tier are counted (see stats() and /metrics).
+"""
+
+import atexit
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from metrics import increment
+
+
+BATTLE_CACHE_FILE = "data/battle_cache.sqlite"
+# Battles kept in memory (a result is ~100 bytes, a battle text a few KiB)
+BATTLE_CACHE_SIZE = 2048
+# Battles kept in the SQLite file
+BATTLE_CACHE_ROWS = 200000
+# New battles written to the SQLite file per commit
+BATTLE_CACHE_BATCH = 256
+
+
+class BattleCache:
+    """
+    In-memory LRU of battle results backed by an optional SQLite table
+    """
+    def __init__(self, max_size=BATTLE_CACHE_SIZE, path=BATTLE_CACHE_FILE, version=None,
+                 max_rows=BATTLE_CACHE_ROWS, batch_size=BATTLE_CACHE_BATCH):
+        """
+        :param max_size: The most battles kept in memory (Default: BATTLE_CACHE_SIZE)
+        :type max_size: int
+        :param path: The SQLite file of the persistent tier, None for memory only (Default: BATTLE_CACHE_FILE)
+        :type path: str
+        :param version: Version of the cached results, rows of other versions are deleted (Default: None)
+        :type version: str
+        :param max_rows: The most battles kept in the SQLite file (Default: BATTLE_CACHE_ROWS)
+        :type max_rows: int
+        :param batch_size: New battles written per commit (Default: BATTLE_CACHE_BATCH)
+        :type batch_size: int
+        """
+        self.max_size = max_size
+        self.path = path
+        self.version = str(version)
+        self.max_rows = max_rows
+        self.batch_size = batch_size
+        self._battles = OrderedDict()
+        # {key: json result} of the battles not written to the SQLite file yet
+        self._pending = {}
+        # _lock guards the memory tier, pending writes and stats, _db_lock the connection
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._stats = {'memory': 0, 'disk': 0, 'miss': 0}
+        self._connection = None
+        if path is not None:
+            try:
+                self._connection = self._open(path)
+            except sqlite3.Error as exc:
+                print(f"Battle cache {path} is memory only because: {exc}")
+                self._connection = None
+            else:
+                atexit.register(self.flush)
+
+    def _open(self, path):
+        """ Opens the SQLite file and deletes the rows of other versions """
+        connection = sqlite3.connect(path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(battles)")]
+        if columns and 'version' not in columns:
+            connection.execute("DROP TABLE battles")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS battles (key TEXT PRIMARY KEY, version TEXT NOT NULL, result TEXT NOT NULL)"
+        )
+        connection.execute("DELETE FROM battles WHERE version != ?", (self.version,))
+        connection.commit()
+        return connection
+
+    @staticmethod
+    def key(pokemon1, pokemon2, league_cp, shields, movesets, version):
+        """ Returns the cache key of a battle """
+        return json.dumps([pokemon1, pokemon2, league_cp, list(shields), [list(m) for m in movesets], version])
+
+    def _count(self, tier):
+        self._stats[tier] += 1
+        increment("battle_cache_requests", tier=tier)
+
+    def get(self, key):
+        """ Returns the cached result (a tuple) or None """
+        with self._lock:
+            result = self._battles.get(key)
+            if result is None and key in self._pending:
+                result = tuple(json.loads(self._pending[key]))
+                self._remember(key, result)
+            if result is not None:
+                self._battles.move_to_end(key)
+                self._count('memory')
+                return result
+
+        row = None
+        if self._connection is not None:
+            with self._db_lock:
+                try:
+                    row = self._connection.execute("SELECT result FROM battles WHERE key = ?", (key,)).fetchone()
+                except sqlite3.Error as exc:
+                    print(f"Failed to read the battle cache because: {exc}")
+
+        with self._lock:
+            if row is None:
+                self._count('miss')
+                return None
+            result = tuple(json.loads(row[0]))
+            self._remember(key, result)
+            self._count('disk')
+        return result
+
+    def put(self, key, result):
+        """ Caches a battle's (winner, leftover health, turns) or battle text lines """
+        result = tuple(result)
+        batch = None
+        with self._lock:
+            self._remember(key, result)
+            if self._connection is not None:
+                self._pending[key] = json.dumps(result)
+                if len(self._pending) >= self.batch_size:
+                    batch, self._pending = self._pending, {}
+        if batch:
+            self._write(batch)
+        return result
+
+    def flush(self):
+        """ Writes the pending battles to the SQLite file """
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch):
+        """ Writes {key: json result} in one commit and trims the table to max_rows """
+        if self._connection is None:
+            return
+        with self._db_lock:
+            try:
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO battles (key, version, result) VALUES (?, ?, ?)",
+                    [(key, self.version, result) for key, result in batch.items()]
+                )
+                # Rows are replaced with a new rowid, so the lowest rowids are the oldest
+                self._connection.execute(
+                    "DELETE FROM battles WHERE rowid <= (SELECT MAX(rowid) FROM battles) - ?", (self.max_rows,)
+                )
+                self._connection.commit()
+            except sqlite3.Error as exc:
+                print(f"Failed to write the battle cache because: {exc}")
+
+    def _remember(self, key, result):
+        self._battles[key] = result
+        self._battles.move_to_end(key)
+        while len(self._battles) > self.max_size:
+            self._battles.popitem(last=False)
+
+    def stats(self):
+        """
+        Returns the hits of each tier, the misses and the hit rates
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._battles)
+        requests = stats['memory'] + stats['disk'] + stats['miss']
+        stats['hit_rate'] = (stats['memory'] + stats['disk']) / requests if requests else 0.0
+        stats['memory_hit_rate'] = stats['memory'] / requests if requests else 0.0
+        return stats
+
+    def clear(self):
+        """ Empties both tiers """
+        with self._lock:
+            self._battles.clear()
+            self._pending.clear()
+        if self._connection is not None:
+            with self._db_lock:
+                self._connection.execute("DELETE FROM battles")
+                self._connection.commit()
@@ -8,6 +8,24 @@ Simulate battles between two pokemon
 '''
 
 import math
+import threading
+from types import MappingProxyType
+
+import numpy as np
+
+from battle_cache import BattleCache
+from metrics import timed
+
+
+# Length of a battle turn (ms)
+TURN_MS = 500
+MAX_ENERGY = 100
+# Part of the battle cache key, changed when the simulation or its text changes
+ENGINE_VERSION = 3
+
+# Process-wide cache of sim_battle results, opened on first use
+_BATTLE_CACHE = None
+_LOCK = threading.Lock()
 
 
 class Move:
@@ -112,16 +130,32 @@ def calculate_cpm_list():
     return cpms, cpm_dict
     
 
+def battle_move(move, damage):
+    """
+    Returns a read only copy of the gamemaster move with its damage in this battle.
+    The gamemaster move itself is shared and never changed.
+    """
+    return MappingProxyType(dict(move, damage=damage))
+
+
+def fast_move_period(cooldown):
+    """
+    Returns every how many turns a fast move is done.
+    A fast move is done on the turns where turns * TURN_MS is a multiple of its cooldown.
+    """
+    return cooldown // math.gcd(cooldown, TURN_MS)
+
+
 def get_pokemon_from_master(master, pokemon_list):
     """
     Returns the pokemon from the game master
     {species1Id: pokemon1, species2Id: pokemon2, ...}
     """
     return_pokemon = {}
-    for p in master.get('pokemon'):
-        for pokemon in pokemon_list:
-            if p.get('speciesId') == pokemon:
-                return_pokemon[pokemon] = p
+    for pokemon in pokemon_list:
+        p = master.get_pokemon(pokemon)
+        if p is not None:
+            return_pokemon[pokemon] = p
     return return_pokemon
 
 
@@ -131,133 +165,124 @@ def get_moves_from_master(master, moves):
     {move1Id: move1, move2Id: move2 ...}
     """
     return_moves = {}
-    for m in master.get('moves'):
-        for move in moves:
-            if m.get('moveId') == move:
-                return_moves[move] = m
+    for move in moves:
+        m = master.get_move(move)
+        if m is not None:
+            return_moves[move] = m
     return return_moves
 
 
-def get_pokemon_stat(pokemon, team_creator, stat):
+def battle_cache():
+    """ Returns the process-wide BattleCache """
+    global _BATTLE_CACHE
+    if _BATTLE_CACHE is None:
+        with _LOCK:
+            if _BATTLE_CACHE is None:
+                _BATTLE_CACHE = BattleCache(version=ENGINE_VERSION)
+    return _BATTLE_CACHE
+
+
+def battle_key(pokemon1, pokemon2, team_creator, shields, kind):
     """
-    Returns the attack stat
+    Returns the battle cache key of a battle's result or trace (kind).
+    Keyed by the pair, league cp, shields, movesets and the gamemaster and stats versions.
     """
-    
-    pokemon_level = pokemon['level']
-    pokemon_cpm = team_creator.cp_multipliers[pokemon_level]
-    stat_value = float(pokemon.get('baseStats').get(stat) + pokemon['ivs'][0 if stat == 'atk' else 1]) * pokemon_cpm
-    return stat_value
+    team_maker = team_creator.team_maker
+    movesets = team_maker.species_moveset_dict
+    version = f"{team_maker.game_master.version}-{team_maker.stat_table.version}-{ENGINE_VERSION}-{kind}"
+    return BattleCache.key(
+        pokemon1, pokemon2, team_maker.league_cp, shields, [movesets.get(pokemon1, ()), movesets.get(pokemon2, ())], version
+    )
 
 
-def calculate_move_damage(move, attacker, defender, team_creator):
+@timed("sim_battle")
+def sim_battle(pokemon1, pokemon2, team_creator, shields=(1, 1)):
     """
-    Returns the amount of damage a move does from the attacker to the defender.
-    The pokemon level and ivs are determined by the default ivs for the chosen league
+    Simulate a battle between two pokemon (cached).
+    Only the result is simulated, see battle_trace() for the battle text.
+
+    :param shields: The number of shields of pokemon1 and pokemon2 (Default: (1, 1))
+    :type shields: tuple
+    :return: The winner, the winner's leftover health fraction and the number of turns
     """
-    attack = get_pokemon_stat(attacker, team_creator, 'atk')
-    defense = get_pokemon_stat(defender, team_creator, 'def')
-
-    '''
-    attacker_level = attacker['level']
-    defender_level = defender['level']
-    attacker_cpm = team_creator.cp_multipliers[attacker_level]
-    defender_cpm = team_creator.cp_multipliers[defender_level]
-    attack = float(attacker.get('baseStats').get('atk') + attacker['ivs'][0]) * attacker_cpm
-    defense = float(defender.get('baseStats').get('def') + defender['ivs'][1]) * defender_cpm
-    '''
-    power = float(move.get('power'))
-
-    stab = 1.2 if move.get('type') in attacker.get('types') else 1.0
-    effectiveness = float(team_creator.get_effectiveness(move.get('type'), defender.get('types')))
-
-    # PVPoke uses a bonus multiplier value. Not sure why..
-    # https://github.com/pvpoke/pvpoke/blob/master/src/js/battle/Battle.js#L221
-    bonus_multiplier = 1.3
-    print(f"{move.get('moveId')} effectiveness: {effectiveness}")
-    print(f"p: {power} - a: {attack} - d: {defense} - s: {stab} - e: {effectiveness}")
-    return math.floor(0.5 * power * attack / defense * stab * effectiveness * bonus_multiplier) + 1
-
-
-def sim_battle(pokemon1, pokemon2, team_creator):
+    key = battle_key(pokemon1, pokemon2, team_creator, shields, 'result')
+    cache = battle_cache()
+    result = cache.get(key)
+    if result is None:
+        result = cache.put(key, simulate_battle(pokemon1, pokemon2, team_creator, shields))
+    return result
+
+
+@timed("battle_trace")
+def battle_trace(pokemon1, pokemon2, team_creator, shields=(1, 1)):
     """
-    Simulate a battle between two pokemon
+    Returns the text of a battle (cached), turn by turn, as a list of lines.
+    Battles are deterministic so this replays the battle sim_battle simulated.
+
+    :param shields: The number of shields of pokemon1 and pokemon2 (Default: (1, 1))
+    :type shields: tuple
+    """
+    key = battle_key(pokemon1, pokemon2, team_creator, shields, 'trace')
+    cache = battle_cache()
+    battle_text = cache.get(key)
+    if battle_text is None:
+        battle_text = []
+        simulate_battle(pokemon1, pokemon2, team_creator, shields, battle_text)
+        battle_text = cache.put(key, battle_text)
+    return list(battle_text)
+
+
+def simulate_battle(pokemon1, pokemon2, team_creator, shields=(1, 1), trace=None):
+    """
+    Simulate a battle between two pokemon (without the cache)
+
+    :param shields: The number of shields of pokemon1 and pokemon2 (Default: (1, 1))
+    :type shields: tuple
+    :param trace: A list the battle text is added to, None to only simulate the result (Default: None)
+    :type trace: list
+    :return: The winner, the winner's leftover health fraction and the number of turns
     """
     movesets = team_creator.team_maker.species_moveset_dict
     game_master = team_creator.team_maker.game_master
 
     # Get data on each pokemon
     pokemon = get_pokemon_from_master(game_master, [pokemon1, pokemon2])
+    # The gamemaster entries are shared by every battle and only read
     pokemon1_data = pokemon[pokemon1]
     pokemon2_data = pokemon[pokemon2]
-    pokemon1_data['moveset'] = movesets[pokemon1]
-    pokemon2_data['moveset'] = movesets[pokemon2]
+    pokemon1_moveset = movesets[pokemon1]
+    pokemon2_moveset = movesets[pokemon2]
 
-    print(pokemon1_data)
-    print(pokemon2_data)
+    # Stats at the league's default IVs, computed once when the league loaded
+    stat_table = team_creator.team_maker.stat_table
+    pokemon1_atk, _, p1_health = stat_table.stats(pokemon1)
+    pokemon2_atk, _, p2_health = stat_table.stats(pokemon2)
 
-    # Get pokemon IVs
-    league_cp = team_creator.team_maker.league_cp
-    pokemon1_ivs = pokemon1_data['defaultIVs'].get(f'cp{league_cp}', [40, 15, 15, 15])
-    pokemon2_ivs = pokemon2_data['defaultIVs'].get(f'cp{league_cp}', [40, 15, 15, 15])
-    print(pokemon1_ivs)
-    print(pokemon2_ivs)
-    pokemon1_data['level'] = pokemon1_ivs[0]
-    pokemon1_data['ivs'] = pokemon1_ivs[1:]
-
-    pokemon2_data['level'] = pokemon2_ivs[0]
-    pokemon2_data['ivs'] = pokemon2_ivs[1:]
-
-    # Get how much damage the moves do
+    # Get how much damage the moves do (looked up in the league's damage table)
     # Damage from pokemon1->2
-    move1_damage = {}
-    pokemon1_moves = get_moves_from_master(game_master, pokemon1_data['moveset'])
-    print(pokemon1_moves)
-    for move in pokemon1_moves.values():
-        move1_damage[move.get('moveId')] = calculate_move_damage(move, pokemon1_data, pokemon2_data, team_creator)
-    print(move1_damage)
-        
-
-    # Damage from pokemon2->2
-    move2_damage = {}
-    pokemon2_moves = get_moves_from_master(game_master, pokemon2_data['moveset'])
-    print(pokemon2_moves)
-    for move in pokemon2_moves.values():
-        move2_damage[move.get('moveId')] = calculate_move_damage(move, pokemon2_data, pokemon1_data, team_creator)
-    print(move2_damage)
+    pokemon1_moves = get_moves_from_master(game_master, pokemon1_moveset)
+    move1_damage = stat_table.move_damages(pokemon1, pokemon2)
+
+    # Damage from pokemon2->1
+    pokemon2_moves = get_moves_from_master(game_master, pokemon2_moveset)
+    move2_damage = stat_table.move_damages(pokemon2, pokemon1)
 
     # Make them battle
 
-    # calculate number of pokemon1 fast moves to charge moves
-    p1_fastmove = pokemon1_moves[movesets[pokemon1][0]]
-    p1_fastmove['damage'] = move1_damage[p1_fastmove['moveId']]
-    p1_chargemove1 = pokemon1_moves[movesets[pokemon1][1]]
-    p1_chargemove1['damage'] = move1_damage[p1_chargemove1['moveId']]
-    p1_chargemove2 = pokemon1_moves[movesets[pokemon1][2]]
-    p1_chargemove2['damage'] = move1_damage[p1_chargemove2['moveId']]
-    p1_count1 = p1_chargemove1['energy'] / p1_fastmove['energyGain']
-    p1_count2 = p1_chargemove2['energy'] / p1_fastmove['energyGain']
-    print(f"pokemon1 counts: {p1_count1} {p1_count2}")
+    # Read only copies of the gamemaster moves with their damage in this battle
+    p1_fastmove = battle_move(pokemon1_moves[pokemon1_moveset[0]], move1_damage[pokemon1_moveset[0]])
+    p1_chargemove1 = battle_move(pokemon1_moves[pokemon1_moveset[1]], move1_damage[pokemon1_moveset[1]])
+    p1_chargemove2 = battle_move(pokemon1_moves[pokemon1_moveset[2]], move1_damage[pokemon1_moveset[2]])
     p1_moveset = Moveset(p1_fastmove, p1_chargemove1, p1_chargemove2)
 
-    # calculate number of pokemon2 fast moves to charge moves
-    p2_fastmove = pokemon2_moves[movesets[pokemon2][0]]
-    p2_fastmove['damage'] = move2_damage[p2_fastmove['moveId']]
-    p2_chargemove1 = pokemon2_moves[movesets[pokemon2][1]]
-    p2_chargemove1['damage'] = move2_damage[p2_chargemove1['moveId']]
-    p2_chargemove2 = pokemon2_moves[movesets[pokemon2][2]]
-    p2_chargemove2['damage'] = move2_damage[p2_chargemove2['moveId']]
-    p2_count1 = p2_chargemove1['energy'] / p2_fastmove['energyGain']
-    p2_count2 = p2_chargemove2['energy'] / p2_fastmove['energyGain']
-    print(f"pokemon2 counts: {p2_count1} {p2_count2}")
+    p2_fastmove = battle_move(pokemon2_moves[pokemon2_moveset[0]], move2_damage[pokemon2_moveset[0]])
+    p2_chargemove1 = battle_move(pokemon2_moves[pokemon2_moveset[1]], move2_damage[pokemon2_moveset[1]])
+    p2_chargemove2 = battle_move(pokemon2_moves[pokemon2_moveset[2]], move2_damage[pokemon2_moveset[2]])
     p2_moveset = Moveset(p2_fastmove, p2_chargemove1, p2_chargemove2)
 
-    p1_health = math.floor((pokemon1_data['baseStats']['hp']+pokemon1_data['ivs'][2])*team_creator.cp_multipliers[pokemon1_data['level']])
-    p2_health = math.floor((pokemon2_data['baseStats']['hp']+pokemon2_data['ivs'][2])*team_creator.cp_multipliers[pokemon2_data['level']])
-    print(f"p1 health: {p1_health} - p2 health: {p2_health}")
     healths = {pokemon1: p1_health, pokemon2: p2_health}
 
     # THE BATTLE
-    shields = [1, 1]
     turns = 0
     pokemons = [
         #Pokemon(pokemon1, p1_health, p1_fastmove, p1_chargemove1, shields[0], pokemon1_data),
@@ -267,21 +292,27 @@ def sim_battle(pokemon1, pokemon2, team_creator):
     ]
 
     # sort pokemon by higher attack to lower
-    pokemons.sort(key=lambda x: get_pokemon_stat(x.data, team_creator, 'atk'), reverse=True)
+    attack_stats = {pokemon1: pokemon1_atk, pokemon2: pokemon2_atk}
+    pokemons.sort(key=lambda x: attack_stats[x.id], reverse=True)
 
-    battle_text = []
+    # Nothing happens between fast moves, so the battle jumps from the next turn
+    # a fast move is done to the next (both pokemon's when they're done on the same turn)
+    periods = [fast_move_period(pokemon.moveset.fast['cooldown']) for pokemon in pokemons]
+    next_turns = list(periods)
+
+    # The battle text is only written when it is asked for
     while pokemons[0].health > 0 and pokemons[1].health > 0:
-        turns += 1
-        health_text = f"{turns}: {pokemons[0]}\t{pokemons[1]}"
-        print(health_text)
-        battle_text.append(health_text)
+        turns = min(next_turns)
+        if trace is not None:
+            trace.append(f"{turns}: {pokemons[0]}\t{pokemons[1]}")
         for num, pokemon in enumerate(pokemons):
             # skip if the pokemon fainted
             if pokemon.health <= 0:
                 continue
 
             # determine if fast move is done
-            if turns * 500 % pokemon.moveset.fast['cooldown'] == 0:
+            if next_turns[num] == turns:
+                next_turns[num] += periods[num]
                 # keep track of other pokemon health
                 pokemons[1-num%2].damage(pokemon.moveset.fast['damage'])
 
@@ -292,19 +323,12 @@ def sim_battle(pokemon1, pokemon2, team_creator):
                 thrown_charge = pokemon.check_charge()
                 #if pokemon.check_charge():
                 if thrown_charge:
-                    charge_text = f"{pokemon} threw {thrown_charge['moveId']}"
-                    print(charge_text)
-                    battle_text.append(charge_text)
+                    if trace is not None:
+                        trace.append(f"{pokemon} threw {thrown_charge['moveId']}")
                     pokemon.energy -= thrown_charge['energy']
                     pokemon.charge_moves_thrown += 1
-                    if not pokemons[1-num%2].take_charge(thrown_charge['damage']):
-                        shield_text = f"{pokemons[1-num%2].id} used a shield"
-                        print(shield_text)
-                        battle_text.append(shield_text)
-
-    finishing_text = f"{pokemons[0]}\t{pokemons[1]}"
-    print(finishing_text)
-    battle_text.append(finishing_text)
+                    if not pokemons[1-num%2].take_charge(thrown_charge['damage']) and trace is not None:
+                        trace.append(f"{pokemons[1-num%2].id} used a shield")
 
     winner = pokemon1
     if pokemons[0].health <= 0:
@@ -314,12 +338,130 @@ def sim_battle(pokemon1, pokemon2, team_creator):
     else:
         winner = pokemons[0].id
         leftover_health =  float(pokemons[0].health) / healths[winner]
-    finishing_text = f"{winner} won with {leftover_health*100:.2f}% health remaining!"
-    print(finishing_text)
-    battle_text.append(finishing_text)
-    
-    return winner, leftover_health, battle_text
-    
+    if trace is not None:
+        trace.append(f"{pokemons[0]}\t{pokemons[1]}")
+        trace.append(f"{winner} won with {leftover_health*100:.2f}% health remaining!")
+
+    return winner, leftover_health, turns
+
+
+@timed("sim_battles")
+def sim_battles(stat_table, pokemon1, pokemon2, shields=1):
+    """
+    Simulate many battles at once with the same rules as sim_battle.
+    Every battle advances a turn at a time as a column of numpy arrays
+    (health, energy, shields, ...) and is dropped from them once it ends.
+
+    :param stat_table: The league's stats and move damages
+    :type stat_table: stat_table.StatTable
+    :param pokemon1: The stat table rows of the first pokemon of each battle
+    :type pokemon1: array-like
+    :param pokemon2: The stat table rows of the second pokemon of each battle
+    :type pokemon2: array-like
+    :param shields: The shields of both pokemon, the (pokemon1, pokemon2) shields of every
+                    battle like sim_battle, or an (n, 2) array of each battle's (Default: 1)
+    :type shields: int or array-like
+    :returns: The winner rows, the winners' leftover health fraction and the
+              number of turns of each battle
+    """
+    pokemon1 = np.asarray(pokemon1, dtype=np.intp).ravel()
+    pokemon2 = np.asarray(pokemon2, dtype=np.intp).ravel()
+    n = len(pokemon1)
+    shields = np.asarray(shields, dtype=np.int64)
+    if shields.ndim == 0 or shields.shape == (2,):
+        shields = np.broadcast_to(shields, (n, 2))
+    elif shields.shape != (n, 2):
+        raise ValueError(f"shields must be a number, a (pokemon1, pokemon2) pair or ({n}, 2), not {shields.shape}")
+    if not (stat_table.complete[pokemon1].all() and stat_table.complete[pokemon2].all()):
+        raise ValueError("Every pokemon needs its whole moveset in the gamemaster")
+
+    # The pokemon with the higher attack moves first (pokemon1 on ties)
+    swap = stat_table.atk[pokemon2] > stat_table.atk[pokemon1]
+    sides = np.stack([np.where(swap, pokemon2, pokemon1), np.where(swap, pokemon1, pokemon2)])
+    start_health = stat_table.hp[sides]
+
+    # Constant move data of each side: fast damage, energy gain and
+    # damage/energy of the higher damage (thrown after the first) and bait charge moves
+    damage = stat_table.damage[sides, :, sides[::-1]].astype(np.int32)
+    move_energy = stat_table.energy[sides].astype(np.int32)
+    ties = damage[..., 1] == damage[..., 2]
+    efficient2 = damage[..., 2] / move_energy[..., 2] > damage[..., 1] / move_energy[..., 1]
+    strong = np.where(ties, np.where(efficient2, 2, 1), np.where(damage[..., 2] > damage[..., 1], 2, 1))
+    bait = np.where(move_energy[..., 2] < move_energy[..., 1], 2, 1)
+    fast, gain, strong_damage, strong_energy, bait_damage, bait_energy = moves = np.stack([
+        damage[..., 0], move_energy[..., 0],
+        np.take_along_axis(damage, strong[..., None], -1)[..., 0],
+        np.take_along_axis(move_energy, strong[..., None], -1)[..., 0],
+        np.take_along_axis(damage, bait[..., None], -1)[..., 0],
+        np.take_along_axis(move_energy, bait[..., None], -1)[..., 0],
+    ]).astype(np.int16)
+
+    # State of each side of the battles still going
+    health, energy, shields_left, thrown = state = np.stack([
+        start_health, np.zeros((2, n)), np.where(swap, shields[:, ::-1].T, shields.T), np.zeros((2, n))
+    ]).astype(np.int16)
+    # A fast move is done on the turns where turn * TURN_MS is a multiple of its cooldown,
+    # so every `period` turns. Finished battles get a next turn that never comes (-1)
+    cooldown = stat_table.cooldown[sides]
+    period, next_turn = schedule = np.stack([cooldown // np.gcd(cooldown, TURN_MS)] * 2).astype(np.int32)
+    battles = np.arange(n)
+    ended_turn = np.zeros(n, dtype=np.int64)
+
+    first_won = np.zeros(n, dtype=bool)
+    leftover = np.zeros(n, dtype=np.int64)
+    turns = np.zeros(n, dtype=np.int64)
+    turn = 0
+    while len(battles):
+        turn += 1
+        for side, other in [(0, 1), (1, 0)]:
+            # Fast move when its cooldown is done (if the pokemon hasn't fainted this turn).
+            # Health isn't clamped at 0, a battle ends once either health is <= 0
+            acting = next_turn[side] == turn
+            if side:
+                acting &= health[side] > 0
+            next_turn[side] += period[side] * acting
+            health[other] -= fast[side] * acting
+            energy[side] += gain[side] * acting
+            np.minimum(energy[side], MAX_ENERGY, out=energy[side])
+
+            # Charge move once there is energy for the higher damage move, baiting first.
+            # Few battles throw one on any turn so only those are updated
+            charging = np.flatnonzero(acting & (energy[side] >= strong_energy[side]))
+            if not len(charging):
+                continue
+            baited = thrown[side, charging] > 0
+            energy[side, charging] -= np.where(baited, strong_energy[side, charging], bait_energy[side, charging])
+            thrown[side, charging] = 1
+            shielded = shields_left[other, charging] > 0
+            shields_left[other, charging] -= shielded
+            charge_damage = np.where(baited, strong_damage[side, charging], bait_damage[side, charging])
+            health[other, charging] -= np.where(shielded, 1, charge_damage)
+
+        # Finished battles stop acting and are only dropped from the arrays once half have finished
+        ended = np.minimum(health[0], health[1]) <= 0
+        newly_ended = np.flatnonzero(ended & (next_turn[0] >= 0))
+        if not len(newly_ended):
+            continue
+        next_turn[:, newly_ended] = -1
+        ended_turn[newly_ended] = turn
+        if 2 * np.count_nonzero(ended) >= len(battles):
+            done = battles[ended]
+            first_won[done] = health[0, ended] > 0
+            leftover[done] = np.maximum(health[0, ended], health[1, ended])
+            turns[done] = ended_turn[ended]
+            going = ~ended
+            battles = battles[going]
+            ended_turn = ended_turn[going]
+            moves = moves[:, :, going]
+            state = state[:, :, going]
+            schedule = schedule[:, :, going]
+            fast, gain, strong_damage, strong_energy, bait_damage, bait_energy = moves
+            health, energy, shields_left, thrown = state
+            period, next_turn = schedule
+
+    winners = np.where(first_won, sides[0], sides[1])
+    return winners, leftover / np.where(first_won, start_health[0], start_health[1]), turns
+
 
 if __name__ == '__main__':
     from team_building import MetaTeamDestroyer, TeamCreater
@@ -333,6 +475,7 @@ if __name__ == '__main__':
     #results = sim_battle('scrafty', 'stunfisk_galarian', tc)
     #results = sim_battle('stunfisk_galarian', 'scrafty', tc)
     results = sim_battle('venusaur', 'ferrothorn', tc)
+    print("\n".join(battle_trace('venusaur', 'ferrothorn', tc)))
     print(results[0], results[1])
     #sim_battle('stunfisk_galarian', 'dialga', tc)
     #sim_battle('talonflame', 'dialga', tc)
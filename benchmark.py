@@ -0,0 +1,606 @@
+"""
+Offline benchmarks for the team builder
+
+Runs against game_master.json and data/latest_{league}.json with the
+network mocked out, so the numbers only measure our own code.
+The files are copied to a temporary directory first, so nothing in the
+repo is written to.
+
+pvpoke rankings aren't stored in the repo. data/rankings_{league}.json is
+used when it exists, otherwise rankings are approximated from the reported
+teams and the type chart.
+
+The suite times the hot paths (team maker construction, counters, team
+building, get_counters_for_rating, sim_battle, sim_battles over every pair
+of the league and a / render through the Flask test client) and reports the best wall time and peak memory of each.
+Results saved with --save can be compared between commits with --compare.
+
+--stress runs thousands of overlapping battle simulations from a thread
+pool and checks they match the same battles simulated one at a time, and
+that the shared gamemaster isn't changed.
+
+--fetch warms every league against a local stand-in HTTP server and checks
+the downloads overlap, stay within the worker limit, reuse pooled
+connections, revalidate with 304s and don't leave partial downloads.
+
+usage: python benchmark.py [league] [--repeat N] [--save results.json]
+       python benchmark.py --compare before.json after.json
+       python benchmark.py [league] --counters | --memory | --stress
+       python benchmark.py --fetch
+"""
+
+import argparse
+import contextlib
+import gc
+import hashlib
+import io
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import numpy as np
+import requests
+
+from game_data import GAME_MASTER_FILE, TYPE_EFFECTIVENESS_FILE, CP_MULTIPLIER_FILE, GameMaster, type_matrix
+
+
+def load_records(league):
+    """ Returns the battle records stored for the league """
+    with open(f"data/latest_{league}.json") as records_file:
+        records = json.load(records_file)
+    return records.get('records', []) if isinstance(records, dict) else records
+
+
+def synthetic_rankings(game_master, records, num_opponents=5):
+    """
+    Approximates a pvpoke rankings file from the reported teams.
+    Each species uses its most reported moveset and its matchups/counters
+    are the species its moves hit hardest / that hit it hardest.
+    """
+    matrix = type_matrix()
+    reported_movesets = defaultdict(Counter)
+    for record in records:
+        for pokemon in record.get('oppo_team').split('/'):
+            species_id, _, moves = pokemon.partition(':')
+            if game_master.get_pokemon(species_id) and moves:
+                reported_movesets[species_id][moves] += 1
+
+    rankings = []
+    for species_id, movesets in reported_movesets.items():
+        pokemon = game_master.get_pokemon(species_id)
+        moves = [m.upper() for m in movesets.most_common(1)[0][0].split(',')]
+        fast = [m for m in moves if m in pokemon.get('fastMoves')] or pokemon.get('fastMoves')[:1]
+        charged = [m for m in moves if m in pokemon.get('chargedMoves')]
+        charged = (charged + [m for m in pokemon.get('chargedMoves') if m not in charged])[:2]
+        moveset = fast[:1] + charged
+        if len(moveset) < 3 or any(game_master.get_move(m) is None for m in moveset):
+            continue
+        # Same fields as a pvpoke rankings entry
+        rankings.append({
+            'speciesId': species_id,
+            'speciesName': pokemon.get('speciesName'),
+            'rating': 500,
+            'moves': {
+                'fastMoves': [{'moveId': m, 'uses': 0} for m in pokemon.get('fastMoves')],
+                'chargedMoves': [{'moveId': m, 'uses': 0} for m in pokemon.get('chargedMoves')],
+            },
+            'moveset': moveset,
+            'score': 50.0,
+            'scores': [50.0] * 6,
+            'stats': dict(pokemon.get('baseStats'), product=0),
+        })
+
+    def best_effectiveness(attacker, defender):
+        defender_types = game_master.get_pokemon(defender['speciesId']).get('types')
+        return max([
+            matrix.effectiveness(game_master.get_move(m).get('type'), defender_types) for m in attacker['moveset']
+        ])
+
+    for species in rankings:
+        scores = sorted([
+            (best_effectiveness(species, other) - best_effectiveness(other, species), other['speciesId'])
+            for other in rankings if other is not species
+        ])
+        species['matchups'] = [{'opponent': o, 'rating': 600} for _, o in scores[::-1][:num_opponents]]
+        species['counters'] = [{'opponent': o, 'rating': 400} for _, o in scores[:num_opponents]]
+    return rankings
+
+
+DATA_FILES = [GAME_MASTER_FILE, TYPE_EFFECTIVENESS_FILE, CP_MULTIPLIER_FILE]
+REPEAT = 5
+# Seed of every run that makes random choices, so runs are comparable
+SEED = 0
+# Battles simulated by the sim_battle case
+N_BATTLES = 10
+# Battles and threads of the --stress check
+STRESS_BATTLES = 4000
+STRESS_THREADS = 16
+# Seconds the --fetch stand-in server takes to answer each request
+FETCH_DELAY = 0.1
+
+
+@contextlib.contextmanager
+def offline_data(league):
+    """
+    Runs the block in a temporary copy of the league's data files with
+    every http request failing, so the cached files are used and nothing
+    in the repo is written to.
+    """
+    records = load_records(league)
+    rankings_file = f"data/rankings_{league}.json"
+    if os.path.exists(rankings_file):
+        with open(rankings_file) as rankings_data:
+            rankings = json.load(rankings_data)
+    else:
+        with open(GAME_MASTER_FILE) as game_master_file:
+            rankings = synthetic_rankings(GameMaster(json.load(game_master_file)), records)
+
+    def offline_request(*args, **kwargs):
+        raise requests.ConnectionError("offline benchmark")
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as data_dir:
+        os.makedirs(os.path.join(data_dir, "data"))
+        for path in DATA_FILES + [f"data/latest_{league}.json"]:
+            shutil.copy(path, os.path.join(data_dir, path))
+        with open(os.path.join(data_dir, rankings_file), 'w') as rankings_data:
+            json.dump(rankings, rankings_data)
+
+        os.chdir(data_dir)
+        try:
+            with mock.patch('requests.sessions.Session.request', offline_request):
+                yield
+        finally:
+            os.chdir(cwd)
+
+
+def measure(func, *args, repeat=5):
+    """
+    Returns the best wall time (s) and peak traced memory (bytes) of func(*args)
+    """
+    best = None
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func(*args)
+            elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def legacy_reccommended_counters(team_maker, pokemon_list):
+    """
+    The previous get_reccommended_counters, which repeated each counter
+    list once per report
+    """
+    counter_leads = []
+    total_reported_pokemon = 0
+    for lead in pokemon_list:
+        counters = list(team_maker.get_counters(lead[0])) * lead[1]
+        counter_leads.append(counters)
+        total_reported_pokemon += lead[1]
+
+    counter_counts = defaultdict(int)
+    for counters in counter_leads:
+        for counter in counters:
+            counter_counts[counter] += 1
+    for count in counter_counts:
+        counter_counts[count] = 100.*counter_counts[count] / float(total_reported_pokemon)
+    return sorted(list(counter_counts.items()), key=lambda x: x[1], reverse=True)
+
+
+def bench_counters(team_maker, scales=(1, 10, 100)):
+    """
+    Compares get_reccommended_counters with the legacy implementation
+    on the league's meta lists, with report counts multiplied by each scale
+    """
+    print(f"{'recommended counters':<32}{'legacy ms':>12}{'legacy KiB':>12}{'matrix ms':>12}{'matrix KiB':>12}")
+    for name in ['leads_list', 'safeswaps_list', 'backs_list']:
+        for scale in scales:
+            pokemon_list = [(p, count * scale) for p, count in getattr(team_maker, name)]
+            legacy_time, legacy_peak = measure(legacy_reccommended_counters, team_maker, pokemon_list)
+            matrix_time, matrix_peak = measure(team_maker.get_reccommended_counters, pokemon_list)
+            print(
+                f"{name + ' x' + str(scale):<32}{legacy_time*1000:>12.2f}{legacy_peak/1024:>12.1f}"
+                f"{matrix_time*1000:>12.2f}{matrix_peak/1024:>12.1f}"
+            )
+
+
+def retained_memory(func, *args):
+    """
+    Returns what func(*args) returns and the memory (bytes) still allocated
+    for it afterwards
+    """
+    gc.collect()
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = func(*args)
+    gc.collect()
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, retained
+
+
+def memory_report(league):
+    """
+    Prints the memory a league cached by the app keeps alive: its rankings,
+    as the raw parsed json kept before and as the league model kept now,
+    and its whole team maker with the records.
+    The shared game data is loaded first so it isn't counted.
+    """
+    import league_model
+    import records
+    from game_data import load_game_master, type_chart, cp_multipliers
+    from http_cache import fetch, RANKINGS_TTL
+    from team_building import MetaTeamDestroyer, LEAGUE_RANKINGS
+
+    load_game_master(), type_chart(), cp_multipliers()
+    resource = fetch(LEAGUE_RANKINGS[league], f"data/rankings_{league}.json", RANKINGS_TTL)
+    def load_rankings():
+        with open(resource.path) as rankings_file:
+            return json.load(rankings_file)
+
+    rankings, rankings_size = retained_memory(load_rankings)
+    league_model._LEAGUE_MODELS.clear()
+    model, model_size = retained_memory(league_model.load_league_model, league, resource)
+
+    league_model._LEAGUE_MODELS.clear()
+    records._FILE_STORES.clear()
+    team_maker, team_maker_size = retained_memory(MetaTeamDestroyer, None, league)
+
+    print(f"{'memory ' + league:<40}{'KiB':>12}")
+    print(f"{'rankings json (' + str(len(rankings)) + ' entries)':<40}{rankings_size/1024:>12.1f}")
+    print(f"{'league model (' + str(len(model.species_ids)) + ' species)':<40}{model_size/1024:>12.1f}")
+    print(f"{'league model / rankings json':<40}{model_size/rankings_size:>12.2f}")
+    print(f"{'team maker':<40}{team_maker_size/1024:>12.1f}")
+    return model, team_maker
+
+
+def suite_cases(league):
+    """
+    Returns the [(name, func)] of every benchmarked hot path of the league.
+    Must be called inside offline_data(league).
+    """
+    import app
+    import league_model
+    import records
+    import stat_table
+    from team_building import MetaTeamDestroyer, TeamCreater, get_counters_for_rating
+    from battle_sim import sim_battle, sim_battles, simulate_battle
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        team_maker = MetaTeamDestroyer(league=league)
+    tc = TeamCreater(team_maker)
+
+    # The most reported leads that can be built around and simulated
+    meta_leads = [
+        p for p, _ in team_maker.leads_list
+        if len(team_maker.species_moveset_dict.get(p, ())) == 3 and team_maker.game_master.get_pokemon(p)
+    ]
+    chosen = next(p for p in meta_leads if team_maker.team_sampler('lead', p).count())
+    battles = [(a, b) for a in meta_leads for b in meta_leads if a != b][:N_BATTLES]
+
+    def construct_cold():
+        league_model._LEAGUE_MODELS.clear()
+        records._FILE_STORES.clear()
+        stat_table._STAT_TABLES.clear()
+        MetaTeamDestroyer(league=league)
+
+    def seeded(func, *args, **kwargs):
+        def run():
+            random.seed(SEED)
+            return func(*args, **kwargs)
+        return run
+
+    def simulate():
+        for pokemon1, pokemon2 in battles:
+            simulate_battle(pokemon1, pokemon2, tc)
+
+    def simulate_cached():
+        for pokemon1, pokemon2 in battles:
+            sim_battle(pokemon1, pokemon2, tc)
+
+    def trace():
+        for pokemon1, pokemon2 in battles:
+            simulate_battle(pokemon1, pokemon2, tc, trace=[])
+
+    # Every pair of simulatable species of the league
+    rows = np.flatnonzero(team_maker.stat_table.complete)
+    league_pokemon1, league_pokemon2 = [r.ravel() for r in np.meshgrid(rows, rows, indexing='ij')]
+
+    client = app.app.test_client()
+
+    def render(query, cached=False):
+        def run():
+            if not cached:
+                app.CACHE.update({'results': {}, 'team_maker': {}, 'num_days': 1, 'rating': None})
+            random.seed(SEED)
+            response = client.get(query)
+            assert response.status_code == 200, response.status_code
+        return run
+
+    return [
+        ("MetaTeamDestroyer (cold)", construct_cold),
+        ("MetaTeamDestroyer (warm)", lambda: MetaTeamDestroyer(league=league)),
+        ("get_reccommended_counters", lambda: team_maker.get_reccommended_counters(team_maker.leads_list)),
+        ("recommend_team lead", seeded(team_maker.recommend_team)),
+        (f"recommend_team lead {chosen}", seeded(team_maker.recommend_team, chosen, position='lead')),
+        (f"recommend_team back {chosen}", seeded(team_maker.recommend_team, chosen, position='back')),
+        ("get_counters_for_rating", seeded(get_counters_for_rating, None, league, None, team_maker)),
+        (f"sim_battle x{len(battles)}", simulate),
+        (f"sim_battle x{len(battles)} (cached)", simulate_cached),
+        (f"sim_battle x{len(battles)} traced", trace),
+        (f"sim_battles x{len(league_pokemon1)}", lambda: sim_battles(team_maker.stat_table, league_pokemon1, league_pokemon2)),
+        ("render /", render(f"/?league={league}")),
+        ("render / (cached)", render(f"/?league={league}", cached=True)),
+        (f"render / {chosen} tooltips", render(f"/?league={league}&pokemon={chosen}&tooltips=1", cached=True)),
+    ]
+
+
+def git_commit():
+    """ Returns the commit of the working tree (None outside of git) """
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(league, repeat=REPEAT):
+    """
+    Times every suite case and returns the results as a json-able dict
+    """
+    commit = git_commit()
+    results = {}
+    with offline_data(league):
+        # The app logs every cell it can't simulate (e.g. unreported '?' pokemon)
+        logging.disable(logging.CRITICAL)
+        try:
+            for name, func in suite_cases(league):
+                seconds, peak = measure(func, repeat=repeat)
+                results[name] = {'seconds': seconds, 'peak_bytes': peak}
+                print(f"{name:<40}{seconds*1000:>12.2f}{peak/1024:>12.1f}")
+        finally:
+            logging.disable(logging.NOTSET)
+    return {
+        'commit': commit,
+        'league': league,
+        'created': time.time(),
+        'repeat': repeat,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'results': results,
+    }
+
+
+def compare(before, after):
+    """ Prints the results of two suite runs side by side """
+    print(f"{'':<40}{before['commit'] or 'before':>12}{after['commit'] or 'after':>12}{'speedup':>10}{'peak KiB':>22}")
+    for name, result in after['results'].items():
+        old = before['results'].get(name)
+        if old is None:
+            print(f"{name:<40}{'':>12}{result['seconds']*1000:>12.2f}{'':>10}{result['peak_bytes']/1024:>22.1f}")
+            continue
+        print(
+            f"{name:<40}{old['seconds']*1000:>12.2f}{result['seconds']*1000:>12.2f}"
+            f"{old['seconds']/result['seconds']:>9.1f}x"
+            f"{old['peak_bytes']/1024:>11.1f}{result['peak_bytes']/1024:>11.1f}"
+        )
+
+
+def stress_battles(league, n_battles=STRESS_BATTLES, threads=STRESS_THREADS):
+    """
+    Simulates n_battles overlapping battles (many sharing species and moves)
+    from a thread pool, uncached and through the battle cache, and checks
+    them and their battle text against the same battles simulated one at a time.
+    Returns True if every battle matched and the gamemaster is unchanged.
+    """
+    from team_building import MetaTeamDestroyer, TeamCreater
+    from battle_sim import battle_trace, sim_battle, simulate_battle
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        team_maker = MetaTeamDestroyer(league=league)
+    tc = TeamCreater(team_maker)
+    stat_table = team_maker.stat_table
+
+    def fingerprint():
+        return hashlib.sha1(json.dumps(team_maker.game_master, sort_keys=True).encode()).hexdigest()
+
+    # A few popular species so the same pokemon and moves are simulated at once
+    rng = random.Random(SEED)
+    species = [stat_table.species_ids[row] for row in np.flatnonzero(stat_table.complete)][:20]
+    battles = [(rng.choice(species), rng.choice(species), rng.choice([(0, 0), (1, 1), (2, 2), (0, 2)])) for _ in range(n_battles)]
+
+    before = fingerprint()
+    with contextlib.redirect_stdout(io.StringIO()):
+        expected_results = [simulate_battle(pokemon1, pokemon2, tc, shields) for pokemon1, pokemon2, shields in battles]
+        expected_traces = []
+        for pokemon1, pokemon2, shields in battles:
+            expected_traces.append([])
+            simulate_battle(pokemon1, pokemon2, tc, shields, expected_traces[-1])
+        results = {}
+        for name, simulate, expected in [("uncached", simulate_battle, expected_results),
+                                         ("cached", sim_battle, expected_results),
+                                         ("traced", battle_trace, expected_traces)]:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                found = list(executor.map(lambda battle: simulate(battle[0], battle[1], tc, battle[2]), battles))
+            results[name] = (found, expected, time.perf_counter() - start)
+    unchanged = fingerprint() == before
+
+    ok = unchanged
+    for name, (found, expected, elapsed) in results.items():
+        mismatches = sum([result != wanted for result, wanted in zip(found, expected)])
+        ok = ok and mismatches == 0
+        print(f"{name + ' x' + str(n_battles) + ' on ' + str(threads) + ' threads':<40}{mismatches:>8} mismatches{elapsed*1000:>12.1f} ms")
+    print(f"{'gamemaster unchanged':<40}{str(unchanged):>8}")
+    return ok
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Serves a small json document for any path with an ETag, answering 304 when
+    it matches If-None-Match, and sends half of /broken/ documents.
+    Counts requests, statuses, connections and the most requests in flight.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            server.connections.add(self.client_address)
+        try:
+            time.sleep(server.delay)
+            body = json.dumps({'path': self.path, 'records': [{'n': n} for n in range(1000)]}).encode()
+            etag = f'"{hashlib.sha1(body).hexdigest()[:12]}"'
+            if self.headers.get('If-None-Match') == etag:
+                status = 304
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+            else:
+                status = 200
+                self.send_response(200)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if self.path.startswith('/broken/'):
+                    body = body[:len(body) // 2]
+                    self.close_connection = True
+                self.wfile.write(body)
+            with server.lock:
+                server.statuses[status] += 1
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+def fetch_check(max_workers=None, delay=FETCH_DELAY):
+    """
+    Warms every league twice against a StandInHandler server: the first time
+    everything is downloaded, the second (TTLs of 0) everything is revalidated.
+    Returns True if every check passed.
+    """
+    import http_cache
+    import team_building
+
+    max_workers = max_workers or team_building.WARM_WORKERS
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.lock = threading.Lock()
+    server.delay = delay
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+
+    def reset():
+        server.in_flight = server.max_in_flight = 0
+        server.connections = set()
+        server.statuses = Counter()
+
+    # Every league's rankings, records and the gamemaster come from the stand-in
+    rankings = {league: f"{base}/rankings/{league}.json" for league in team_building.LEAGUE_RANKINGS}
+    latest = {league: f"{base}/records/{league}/latest.json" for league in team_building.LEAGUE_DATA}
+    checks = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as data_dir, contextlib.ExitStack() as stack:
+        os.makedirs(os.path.join(data_dir, "data"))
+        os.chdir(data_dir)
+        stack.callback(os.chdir, cwd)
+        stack.enter_context(mock.patch.dict(team_building.LEAGUE_RANKINGS, rankings))
+        stack.enter_context(mock.patch.dict(team_building.LEAGUE_DATA, latest))
+        stack.enter_context(mock.patch('team_building.GAME_MASTER_URL', f"{base}/gamemaster.json"))
+        for ttl in ['GAME_MASTER_TTL', 'RANKINGS_TTL', 'RECORDS_TTL']:
+            stack.enter_context(mock.patch(f'team_building.{ttl}', 0))
+        stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+        n_resources = len({path for league in team_building.LEAGUE_RANKINGS for _, path, _ in team_building.league_resources(league)})
+
+        for name, status in [("download", 200), ("revalidate", 304)]:
+            reset()
+            start = time.perf_counter()
+            errors = team_building.warm_leagues(max_workers=max_workers)
+            elapsed = time.perf_counter() - start
+            checks += [
+                (f"{name}: no errors", not errors),
+                (f"{name}: {n_resources} requests, all {status}", server.statuses == Counter({status: n_resources})),
+                (f"{name}: {server.max_in_flight} in flight (1 < n <= {max_workers})", 1 < server.max_in_flight <= max_workers),
+                (f"{name}: {len(server.connections)} connections (<= {max_workers})", len(server.connections) <= max_workers),
+                (f"{name}: {elapsed*1000:.0f} ms (serial {n_resources * delay * 1000:.0f} ms)", elapsed < n_resources * delay),
+            ]
+
+        # A broken download fails without leaving its temp file behind
+        reset()
+        path = os.path.join("data", "broken.json")
+        result, = http_cache.fetch_all([(f"{base}/broken/records.json", path, 0)], raise_errors=False)
+        checks += [
+            ("broken download fails", isinstance(result, Exception)),
+            ("broken download leaves no temp file", not [f for f in os.listdir("data") if f.endswith('.tmp')]),
+        ]
+    server.shutdown()
+    server.server_close()
+
+    for name, passed in checks:
+        print(f"{name:<60}{'ok' if passed else 'FAILED':>8}")
+    return all([passed for _, passed in checks])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the team builder")
+    parser.add_argument('league', nargs='?', default="Holiday")
+    parser.add_argument('--repeat', type=int, default=REPEAT, help="runs per case (the best is kept)")
+    parser.add_argument('--save', help="write the suite results to this json file")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help="compare two saved results")
+    parser.add_argument('--counters', action='store_true', help="compare get_reccommended_counters with the legacy version")
+    parser.add_argument('--memory', action='store_true', help="report the memory a cached league keeps alive")
+    parser.add_argument('--stress', action='store_true', help="check battles simulated from many threads at once")
+    parser.add_argument('--fetch', action='store_true', help="check warm_leagues against a local stand-in server")
+    args = parser.parse_args()
+
+    if args.fetch:
+        if not fetch_check():
+            raise SystemExit(1)
+    elif args.compare:
+        with open(args.compare[0]) as before_file, open(args.compare[1]) as after_file:
+            compare(json.load(before_file), json.load(after_file))
+    elif args.counters or args.memory or args.stress:
+        from team_building import MetaTeamDestroyer
+
+        with offline_data(args.league):
+            if args.stress:
+                if not stress_battles(args.league):
+                    raise SystemExit(1)
+            elif args.memory:
+                memory_report(args.league)
+            else:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    team_maker = MetaTeamDestroyer(league=args.league)
+                bench_counters(team_maker)
+    else:
+        print(f"{args.league + ' suite':<40}{'best ms':>12}{'peak KiB':>12}")
+        suite = run_suite(args.league, repeat=args.repeat)
+        if args.save:
+            with open(args.save, 'w') as results_file:
+                json.dump(suite, results_file, indent=1)
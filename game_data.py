@@ -0,0 +1,300 @@
+"""
+Game data shared by the team builder and the battle simulator
+
+The gamemaster is large (1000+ species, 250+ moves) and is only needed
+as lookups by id, so it is loaded once per process and indexed.
+
+The type chart and cp multipliers from pogoapi rarely change, so they are
+read from versioned snapshots in data/ and only refreshed in the background.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import requests
+
+from http_cache import fetch, GAME_MASTER_TTL
+
+
+GAME_MASTER_URL = "https://vps.gobattlelog.com/data/gamemaster.json?v=1.25.10"
+GAME_MASTER_FILE = "game_master.json"
+TYPE_EFFECTIVENESS_URL = "https://pogoapi.net//api/v1/type_effectiveness.json"
+TYPE_EFFECTIVENESS_FILE = "data/type_effectiveness.json"
+CP_MULTIPLIER_URL = "https://pogoapi.net//api/v1/cp_multiplier.json"
+CP_MULTIPLIER_FILE = "data/cp_multiplier.json"
+REQUEST_TIMEOUT = 180
+REFRESH_INTERVAL = 24 * 60 * 60
+
+# https://gamepress.gg/pokemongo/cp-multiplier
+HIGH_MULTIPLIERS = {
+    45.5: 0.81779999,
+    46: 0.82029999,
+    46.5: 0.82279999,
+    47: 0.82529999,
+    47.5: 0.82779999,
+    48: 0.83029999,
+    48.5: 0.83279999,
+    49: 0.83529999,
+    49.5: 0.83779999,
+    50: 0.84029999,
+    50.5: 0.84279999,
+    51: 0.84529999
+}
+
+_GAME_MASTER = None
+_TYPE_CHART = None
+_TYPE_MATRIX = None
+_CP_MULTIPLIERS = None
+_REFRESH_THREAD = None
+_LOCK = threading.Lock()
+
+
+class GameMaster(dict):
+    """
+    The gamemaster json indexed by species and move ids.
+
+    Still behaves like the raw gamemaster dict so existing
+    `game_master.get('pokemon')` calls keep working.
+    """
+    def __init__(self, data, version=None):
+        super().__init__(data)
+        self.version = version
+        self.pokemon_by_id = {p.get('speciesId'): p for p in self.get('pokemon', [])}
+        self.moves_by_id = {m.get('moveId'): m for m in self.get('moves', [])}
+
+        # {speciesId: {moveId: position}} for building pvpoke moveset strings
+        self.fast_move_positions = {}
+        self.charged_move_positions = {}
+        for species_id, pokemon in self.pokemon_by_id.items():
+            fast_positions, charged_positions = {}, {}
+            for n, move in enumerate(pokemon.get('fastMoves', [])):
+                fast_positions.setdefault(move, n)
+            for n, move in enumerate(pokemon.get('chargedMoves', [])):
+                charged_positions.setdefault(move, n)
+            self.fast_move_positions[species_id] = fast_positions
+            self.charged_move_positions[species_id] = charged_positions
+
+        # Row of each species in the per-species tables below
+        self.species_index = {species_id: n for n, species_id in enumerate(self.pokemon_by_id)}
+        self._weakness_table = None
+
+    def get_pokemon(self, species_id):
+        """ Returns the gamemaster entry for the species (or None) """
+        return self.pokemon_by_id.get(species_id)
+
+    def get_move(self, move_id):
+        """ Returns the gamemaster entry for the move (or None) """
+        return self.moves_by_id.get(move_id)
+
+    def moveset_positions(self, species_id, moveset):
+        """
+        Returns the positions of the moveset in the species' move lists
+        as used in pvpoke urls: [fast, charged1+1, charged2+1]
+        """
+        fast_positions = self.fast_move_positions.get(species_id)
+        if fast_positions is None:
+            return []
+        charged_positions = self.charged_move_positions[species_id]
+        positions = []
+        if moveset and moveset[0] in fast_positions:
+            positions.append(fast_positions[moveset[0]])
+        for move in moveset[1:]:
+            if move in charged_positions:
+                positions.append(charged_positions[move] + 1)
+        return positions
+
+    def weakness_table(self, matrix):
+        """
+        Returns the weakness vectors and bitmasks of every species
+        (rows follow species_index) against the given TypeMatrix.
+        Computed once per type matrix.
+        """
+        if self._weakness_table is None or self._weakness_table[0] is not matrix:
+            type_rows = [
+                [t for t in pokemon.get('types', []) if t != 'none'] or ['none']
+                for pokemon in self.pokemon_by_id.values()
+            ]
+            most_types = max([len(types) for types in type_rows], default=1)
+            type_indexes = np.array([
+                [matrix.index.get(t, matrix.none_index) for t in types] + [matrix.none_index] * (most_types - len(types))
+                for types in type_rows
+            ], dtype=np.intp).reshape(len(type_rows), most_types)
+            vectors = matrix.weakness_vectors(type_indexes)
+            masks = matrix.weakness_masks(vectors)
+            self._weakness_table = (matrix, vectors, masks)
+        return self._weakness_table[1], self._weakness_table[2]
+
+
+class TypeMatrix:
+    """
+    The type chart as an 18x18 numpy matrix of [attacker, defender] multipliers
+    """
+    def __init__(self, chart):
+        self.chart = chart
+        self.names = list(chart)
+        self.index = {name.lower(): n for n, name in enumerate(self.names)}
+        # Extra all-ones defender column so 'none'/unknown types don't change products
+        self.none_index = len(self.names)
+        self.matrix = np.ones((len(self.names), len(self.names) + 1))
+        for a, attacker in enumerate(self.names):
+            for d, defender in enumerate(self.names):
+                self.matrix[a, d] = chart[attacker][defender]
+
+    def effectiveness(self, attacker_type, defender_types):
+        """ Returns the effectiveness of attack type on defender types """
+        row = self.matrix[self.index[attacker_type.lower()]]
+        effectiveness = 1
+        for defender_type in defender_types:
+            effectiveness *= row[self.index.get(defender_type.lower(), self.none_index)]
+        return effectiveness
+
+    def weakness_vectors(self, type_indexes):
+        """
+        Returns the multiplier of every attacking type on each row of defender
+        type indexes: (n, k) indexes -> (n, 18) multipliers
+        """
+        vectors = np.ones((type_indexes.shape[0], len(self.names)))
+        for column in range(type_indexes.shape[1]):
+            vectors = vectors * self.matrix[:, type_indexes[:, column]].T
+        return vectors
+
+    @staticmethod
+    def weakness_masks(vectors):
+        """ Returns a bitmask per row with a bit set for each super effective type """
+        bits = np.left_shift(1, np.arange(vectors.shape[1], dtype=np.uint32), dtype=np.uint32)
+        return np.where(vectors > 1.0, bits, 0).sum(axis=1).astype(np.uint32)
+
+
+def load_game_master():
+    """
+    Returns the process-wide GameMaster.
+    The gamemaster file is revalidated through the http cache and only
+    parsed and indexed again when its content changes.
+    """
+    global _GAME_MASTER
+    resource = fetch(GAME_MASTER_URL, GAME_MASTER_FILE, GAME_MASTER_TTL)
+    if _GAME_MASTER is None or _GAME_MASTER.version != resource.version:
+        with open(resource.path) as game_master_file:
+            _GAME_MASTER = GameMaster(json.load(game_master_file), version=resource.version)
+    return _GAME_MASTER
+
+
+def snapshot_version(data):
+    """ Returns a short content hash used as the version of a snapshot """
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def load_snapshot(path):
+    """
+    Returns the (version, data) stored in a snapshot file
+    """
+    with open(path) as snapshot_file:
+        snapshot = json.load(snapshot_file)
+    return snapshot.get('version'), snapshot.get('data')
+
+
+def save_snapshot(path, url, data):
+    """
+    Atomically writes the data to a snapshot file and returns its version
+    """
+    version = snapshot_version(data)
+    snapshot = {'version': version, 'source': url, 'fetched': time.time(), 'data': data}
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as snapshot_file:
+        json.dump(snapshot, snapshot_file, indent=1)
+    os.replace(temp_path, path)
+    return version
+
+
+def _build_cp_multipliers(cp_multiplier_data):
+    """ Converts pogoapi's cp multiplier list to {level: multiplier} """
+    cp_multipliers = {cpm['level']: cpm['multiplier'] for cpm in cp_multiplier_data}
+    cp_multipliers.update(HIGH_MULTIPLIERS)
+    return cp_multipliers
+
+
+def type_chart():
+    """
+    Returns the process-wide type chart {attacker: {defender: multiplier}}
+    """
+    global _TYPE_CHART
+    if _TYPE_CHART is None:
+        with _LOCK:
+            if _TYPE_CHART is None:
+                _TYPE_CHART = load_snapshot(TYPE_EFFECTIVENESS_FILE)[1]
+    return _TYPE_CHART
+
+
+def type_matrix():
+    """
+    Returns the process-wide TypeMatrix for the current type chart
+    """
+    global _TYPE_MATRIX
+    chart = type_chart()
+    if _TYPE_MATRIX is None or _TYPE_MATRIX.chart is not chart:
+        _TYPE_MATRIX = TypeMatrix(chart)
+    return _TYPE_MATRIX
+
+
+def cp_multipliers():
+    """
+    Returns the process-wide cp multipliers {level: multiplier}
+    """
+    global _CP_MULTIPLIERS
+    if _CP_MULTIPLIERS is None:
+        with _LOCK:
+            if _CP_MULTIPLIERS is None:
+                _CP_MULTIPLIERS = _build_cp_multipliers(load_snapshot(CP_MULTIPLIER_FILE)[1])
+    return _CP_MULTIPLIERS
+
+
+def refresh_pogoapi_data():
+    """
+    Downloads the type chart and cp multipliers from pogoapi and replaces
+    the snapshots if they changed.
+    Returns True if either table changed.
+    """
+    global _TYPE_CHART, _CP_MULTIPLIERS
+    changed = False
+    for url, path in [(TYPE_EFFECTIVENESS_URL, TYPE_EFFECTIVENESS_FILE), (CP_MULTIPLIER_URL, CP_MULTIPLIER_FILE)]:
+        try:
+            data = requests.get(url, timeout=REQUEST_TIMEOUT).json()
+        except Exception as exc:
+            print(f"Failed to refresh {url} because: {exc}")
+            continue
+
+        old_version = load_snapshot(path)[0] if os.path.exists(path) else None
+        if snapshot_version(data) == old_version:
+            continue
+        save_snapshot(path, url, data)
+        changed = True
+
+        # Swap in the new table; readers keep whichever dict they already have
+        with _LOCK:
+            if path == TYPE_EFFECTIVENESS_FILE:
+                _TYPE_CHART = data
+            else:
+                _CP_MULTIPLIERS = _build_cp_multipliers(data)
+    return changed
+
+
+def start_background_refresh(interval=REFRESH_INTERVAL):
+    """
+    Starts a daemon thread that refreshes the pogoapi snapshots every interval seconds
+    """
+    global _REFRESH_THREAD
+    if _REFRESH_THREAD is not None:
+        return _REFRESH_THREAD
+
+    def refresh_loop():
+        while True:
+            refresh_pogoapi_data()
+            time.sleep(interval)
+
+    _REFRESH_THREAD = threading.Thread(target=refresh_loop, name="pogoapi-refresh", daemon=True)
+    _REFRESH_THREAD.start()
+    return _REFRESH_THREAD
@@ -0,0 +1,220 @@
+"""
+Local HTTP cache for the downloaded league data
+
+Every resource is kept as a file (game_master.json, data/rankings_{league}.json,
+data/latest_{league}.json) with a {path}.meta.json sidecar holding its
+ETag/Last-Modified, content version and when it was last checked.
+
+  - Inside its TTL the file is used without touching the network.
+  - After the TTL it is revalidated with a conditional request, so unchanged
+    data costs a single 304.
+  - New data is streamed to a temp file and atomically moved into place.
+  - If the server can't be reached the stale file is used for another TTL.
+
+Requests share one keep-alive session pool, and fetch_all() fetches several
+resources concurrently.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import increment, span
+
+
+REQUEST_TIMEOUT = 180
+CHUNK_SIZE = 64 * 1024
+# Most concurrent requests (and pooled connections per host)
+MAX_WORKERS = 8
+
+# Seconds before each kind of resource is revalidated
+GAME_MASTER_TTL = 24 * 60 * 60
+RANKINGS_TTL = 6 * 60 * 60
+RECORDS_TTL = 10 * 60
+
+CachedResource = namedtuple('CachedResource', ['path', 'version', 'status'])
+
+# {path: metadata} so fresh resources don't even read the sidecar
+_META = {}
+_LOCK = threading.Lock()
+_SESSION = None
+
+
+def shared_session():
+    """ Returns the process-wide keep-alive session """
+    global _SESSION
+    with _LOCK:
+        if _SESSION is None:
+            _SESSION = requests.Session()
+            adapter = HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS)
+            _SESSION.mount('http://', adapter)
+            _SESSION.mount('https://', adapter)
+    return _SESSION
+
+
+def meta_path(path):
+    """ Returns the path of the metadata sidecar of a cached file """
+    return f"{path}.meta.json"
+
+
+def file_version(path):
+    """ Returns a short content hash of the file """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as cached_file:
+        for chunk in iter(lambda: cached_file.read(CHUNK_SIZE), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()[:12]
+
+
+def _load_meta(path):
+    """ Returns the metadata of the cached file (None if there isn't any) """
+    with _LOCK:
+        meta = _META.get(os.path.abspath(path))
+    if meta is not None:
+        return meta
+    try:
+        with open(meta_path(path)) as meta_file:
+            meta = json.load(meta_file)
+    except (OSError, ValueError):
+        return None
+    with _LOCK:
+        _META[os.path.abspath(path)] = meta
+    return meta
+
+
+def _save_meta(path, meta):
+    """ Atomically writes the metadata of the cached file """
+    temp_path = f"{meta_path(path)}.tmp"
+    with open(temp_path, 'w') as meta_file:
+        json.dump(meta, meta_file)
+    os.replace(temp_path, meta_path(path))
+    with _LOCK:
+        _META[os.path.abspath(path)] = meta
+
+
+def _stale_resource(url, path, meta):
+    """
+    Returns the file already on disk after a failed request.
+    It is treated as fresh for another TTL so an unreachable server
+    isn't retried on every call.
+    """
+    meta = dict(meta or {}, url=url, checked=time.time())
+    if meta.get('version') is None:
+        meta['version'] = file_version(path)
+    _save_meta(path, meta)
+    return CachedResource(path, meta['version'], 'stale')
+
+
+def fetch(url, path, ttl, timeout=REQUEST_TIMEOUT, session=None):
+    """
+    Returns an up to date copy of the url saved at path.
+
+    :param url: The url of the resource
+    :type url: str
+    :param path: The file the resource is cached in
+    :type path: str
+    :param ttl: Seconds the cached file is used before revalidating it
+    :type ttl: float
+    :param session: Session to make the request with (Default: the shared session)
+    :type session: requests.Session
+
+    :return: the path, content version and 'hit', 'revalidated',
+             'downloaded' or 'stale'
+    :rtype: CachedResource
+    """
+    with span("fetch"):
+        resource = _fetch(url, path, ttl, timeout, session)
+    increment("http_cache_requests", status=resource.status)
+    return resource
+
+
+def _fetch(url, path, ttl, timeout, session):
+    """ Does the work of fetch() """
+    meta = _load_meta(path)
+    have_file = os.path.exists(path)
+    if have_file and meta and meta.get('url') == url and time.time() - meta.get('checked', 0) < ttl:
+        return CachedResource(path, meta['version'], 'hit')
+
+    headers = {}
+    if have_file and meta and meta.get('url') == url:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    response = None
+    temp_path = f"{path}.{threading.get_ident()}.tmp"
+    try:
+        response = (session or shared_session()).get(url, headers=headers, timeout=timeout, stream=True)
+        if response.status_code == 304:
+            # Reading the empty body puts the connection back in the pool
+            response.content
+            meta = dict(meta, checked=time.time())
+            _save_meta(path, meta)
+            return CachedResource(path, meta['version'], 'revalidated')
+        response.raise_for_status()
+
+        # Stream to a temp file so readers never see a partial download
+        sha1 = hashlib.sha1()
+        with open(temp_path, 'wb') as temp_file:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                sha1.update(chunk)
+                temp_file.write(chunk)
+        os.replace(temp_path, path)
+    except Exception as exc:
+        if not have_file:
+            raise
+        print(f"Failed to fetch {url} because: {exc}. Using {path}")
+        return _stale_resource(url, path, meta)
+    finally:
+        # Give the connection back to the pool and don't leave a partial download behind
+        if response is not None:
+            response.close()
+        if os.path.exists(temp_path):
+            try:
+                os.remove(temp_path)
+            except OSError as exc:
+                print(f"Failed to remove {temp_path} because: {exc}")
+
+    meta = {
+        'url': url,
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'version': sha1.hexdigest()[:12],
+        'checked': time.time(),
+    }
+    _save_meta(path, meta)
+    return CachedResource(path, meta['version'], 'downloaded')
+
+
+def fetch_all(resources, max_workers=MAX_WORKERS, raise_errors=True):
+    """
+    Fetches the resources concurrently over the shared session.
+
+    :param resources: (url, path, ttl) of each resource
+    :type resources: list
+    :param max_workers: The most requests made at once (Default: MAX_WORKERS)
+    :type max_workers: int
+    :param raise_errors: Raise the first failure instead of returning it (Default: True)
+    :type raise_errors: bool
+
+    :return: the CachedResource (or exception) of each resource, in order
+    :rtype: list
+    """
+    def fetch_resource(resource):
+        try:
+            return fetch(*resource)
+        except Exception as exc:
+            if raise_errors:
+                raise
+            return exc
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(resources)))) as executor:
+        return list(executor.map(fetch_resource, resources))
@@ -0,0 +1,124 @@
+"""
+Counter relationships of a league from its pvpoke rankings
+
+Everything here only depends on the rankings file, so a LeagueModel is
+built once per rankings version and shared (read only) by every
+MetaTeamDestroyer and meta view of the league. Only the record based
+meta lists change between days_back/rating queries.
+"""
+
+import json
+import sys
+import threading
+from collections import defaultdict
+from types import MappingProxyType
+
+import numpy as np
+
+from metrics import count_cache, span
+
+
+# {league: (rankings version, LeagueModel)} of rankings already built
+_LEAGUE_MODELS = {}
+_LOCK = threading.Lock()
+
+
+class SpeciesRecord:
+    """
+    The fields of a rankings entry the team builder and the app use
+    """
+    __slots__ = ('species_id', 'moveset')
+
+    def __init__(self, species_id, moveset):
+        self.species_id = species_id
+        self.moveset = moveset
+
+    def __repr__(self):
+        return f"SpeciesRecord({self.species_id!r}, {self.moveset!r})"
+
+
+class LeagueModel:
+    """
+    Immutable counter, weakness and moveset lookups of a league's rankings
+    """
+    def __init__(self, all_pokemon, version=None):
+        """
+        :param all_pokemon: The pvpoke rankings of the league (only read while building)
+        :type all_pokemon: list
+        :param version: The content version of the rankings (Default: None)
+        :type version: str
+        """
+        self.version = version
+
+        # Only the relations and a compact record of each species are kept,
+        # the rankings json itself is dropped once the model is built.
+        # Ids are interned so every mapping shares one copy of each string
+        species_counters = defaultdict(set)# pokemon that each pokemon counters well
+        species_weaknesses = defaultdict(set)# pokemon that each pokemon is weak to
+        species_movesets = {}
+        records = []
+        for species in all_pokemon:
+            counters = [sys.intern(c.get('opponent')) for c in species.get('counters')]
+            matchups = [sys.intern(m.get('opponent')) for m in species.get('matchups')]
+            species_id = sys.intern(species.get('speciesId'))
+            species_counters[species_id].update(counters)
+            species_weaknesses[species_id].update(matchups)
+
+            # Add the species as counters to the matchups
+            for matchup in matchups:
+                species_counters[matchup].add(species_id)
+
+            for counter in counters:
+                species_weaknesses[counter].add(species_id)
+
+            moveset = tuple([sys.intern(m) for m in species.get('moveset')])
+            species_movesets[species_id] = moveset
+            records.append(SpeciesRecord(species_id, moveset))
+        self.all_pokemon = tuple(records)
+
+        self.species_counters_dict = MappingProxyType({p: frozenset(c) for p, c in species_counters.items()})
+        self.species_weaknesses_dict = MappingProxyType({p: frozenset(w) for p, w in species_weaknesses.items()})
+        self.species_moveset_dict = MappingProxyType(species_movesets)
+
+        # Counter relationships as a species x species matrix:
+        #  counter_matrix[index[p], index[c]] == 1 when c is in p's counters
+        self.species_ids = tuple(sorted(
+            set(self.species_counters_dict).union(*self.species_counters_dict.values())
+        ))
+        self.species_index = MappingProxyType({species_id: n for n, species_id in enumerate(self.species_ids)})
+        self.counter_matrix = np.zeros((len(self.species_ids), len(self.species_ids)), dtype=np.float32)
+        for species_id, counters in self.species_counters_dict.items():
+            counter_rows = [self.species_index[c] for c in counters]
+            self.counter_matrix[self.species_index[species_id], counter_rows] = 1
+        self.counter_matrix.flags.writeable = False
+
+        # The same relations as bool arrays, one row per species:
+        #  counter_relation[p] = the counters of p (species_counters_dict[p])
+        #  weakness_relation[p] = species_weaknesses_dict[p]
+        self.counter_relation = self.counter_matrix > 0
+        self.weakness_relation = np.ascontiguousarray(self.counter_relation.T)
+        self.counter_relation.flags.writeable = False
+        self.weakness_relation.flags.writeable = False
+
+
+def load_league_model(league, resource):
+    """
+    Returns the LeagueModel of the league's cached rankings.
+    The rankings are only parsed and built again when their content changes.
+
+    :param league: The league of the rankings
+    :type league: str
+    :param resource: The cached rankings file
+    :type resource: http_cache.CachedResource
+    """
+    cached = _LEAGUE_MODELS.get(league)
+    hit = cached is not None and cached[0] == resource.version
+    if not hit:
+        with _LOCK, span("league_model"):
+            cached = _LEAGUE_MODELS.get(league)
+            if cached is None or cached[0] != resource.version:
+                with open(resource.path) as rankings_file:
+                    model = LeagueModel(json.load(rankings_file), version=resource.version)
+                cached = _LEAGUE_MODELS[league] = (resource.version, model)
+    count_cache("league_model", hit)
+    return cached[1]
@@ -0,0 +1,212 @@
+"""
+Every battle of a league simulated ahead of time
+
+The meta tables color each pokemon by how it does against the chosen
+pokemon, which used to simulate the same battles on every page view.
+This job simulates every ranked species against every other at 0-0, 1-1
+and 2-2 shields, spread over all cores, and stores the winner, leftover
+health and turns in a .npy file per league and stats version:
+
+  data/matchups_{league}_{version}.npy         (shields, pokemon1, pokemon2) records
+  data/matchups_{league}_{version}.npy.meta.json
+
+The version is the stat table's content hash, so a new rankings,
+gamemaster or type chart gives a new file. Web workers memory map the file
+and look battles up instead of simulating them.
+
+usage: python matchup_matrix.py [league ...] [--processes N]
+"""
+
+import argparse
+import glob
+import json
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from battle_sim import sim_battles
+from metrics import count_cache, span
+
+
+# Shields of both pokemon in each stored scenario
+SHIELD_SCENARIOS = (0, 1, 2)
+MATCHUP_DIR = "data"
+MATCHUP_DTYPE = np.dtype([('winner', np.int16), ('leftover', np.float64), ('turns', np.int16)])
+# Battles per worker task
+CHUNK_BATTLES = 50000
+
+# {league: MatchupMatrix} of the files already opened
+_MATCHUPS = {}
+_LOCK = threading.Lock()
+# Stat table of the worker processes
+_WORKER_TABLE = None
+
+
+def matchup_path(league, version):
+    """ Returns the path of the league's matchup file for a stats version """
+    return os.path.join(MATCHUP_DIR, f"matchups_{league}_{version}.npy")
+
+
+class MatchupMatrix:
+    """
+    Read only lookups in a league's stored matchups
+    """
+    def __init__(self, stat_table, path):
+        """
+        :param stat_table: The stat table the matchups were simulated with
+        :type stat_table: stat_table.StatTable
+        :param path: The matchup file
+        :type path: str
+        """
+        self.stat_table = stat_table
+        self.version = stat_table.version
+        self.matchups = np.load(path, mmap_mode='r')
+        self.shield_index = {shields: n for n, shields in enumerate(SHIELD_SCENARIOS)}
+
+    def lookup(self, pokemon1, pokemon2, shields=1):
+        """
+        Returns the (winner, leftover health, turns) of pokemon1 against
+        pokemon2 with the same shields on both, or None if it isn't stored
+        """
+        scenario = self.shield_index.get(shields)
+        row1 = self.stat_table.index.get(pokemon1)
+        row2 = self.stat_table.index.get(pokemon2)
+        if scenario is None or row1 is None or row2 is None:
+            return None
+        winner, leftover, turns = self.matchups[scenario, row1, row2].tolist()
+        if winner < 0:
+            return None
+        return self.stat_table.species_ids[winner], leftover, turns
+
+
+def load_matchups(league, stat_table):
+    """
+    Returns the league's MatchupMatrix for the stat table, or None if the
+    matchups of this stats version haven't been simulated
+    """
+    matchups = _MATCHUPS.get(league)
+    hit = matchups is not None and matchups.version == stat_table.version
+    if not hit:
+        path = matchup_path(league, stat_table.version)
+        if not os.path.exists(path):
+            count_cache("matchups", False)
+            return None
+        with _LOCK:
+            matchups = _MATCHUPS.get(league)
+            if matchups is None or matchups.version != stat_table.version:
+                matchups = _MATCHUPS[league] = MatchupMatrix(stat_table, path)
+    count_cache("matchups", hit)
+    return matchups
+
+
+def _init_worker(stat_table):
+    global _WORKER_TABLE
+    _WORKER_TABLE = stat_table
+
+
+def _simulate_chunk(pokemon1, pokemon2, shields):
+    """ Worker task: simulates the battles with the worker's stat table """
+    return sim_battles(_WORKER_TABLE, pokemon1, pokemon2, shields)
+
+
+def simulate_matchups(stat_table, processes=None):
+    """
+    Returns the (shields, pokemon1, pokemon2) MATCHUP_DTYPE records of every
+    battle between the stat table's species. Battles of species missing
+    moves have a winner of -1.
+
+    :param stat_table: The league's stats and move damages
+    :type stat_table: stat_table.StatTable
+    :param processes: The number of worker processes (Default: all cores)
+    :type processes: int
+    """
+    n = len(stat_table.species_ids)
+    matchups = np.zeros((len(SHIELD_SCENARIOS), n, n), dtype=MATCHUP_DTYPE)
+    matchups['winner'] = -1
+
+    rows = np.flatnonzero(stat_table.complete)
+    if not len(rows):
+        return matchups
+    pokemon1, pokemon2 = [r.ravel() for r in np.meshgrid(rows, rows, indexing='ij')]
+    chunks = [slice(start, start + CHUNK_BATTLES) for start in range(0, len(pokemon1), CHUNK_BATTLES)]
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(stat_table,)) as executor:
+        tasks = [
+            (scenario, chunk, executor.submit(_simulate_chunk, pokemon1[chunk], pokemon2[chunk], shields))
+            for scenario, shields in enumerate(SHIELD_SCENARIOS) for chunk in chunks
+        ]
+        for scenario, chunk, task in tasks:
+            for field, values in zip(MATCHUP_DTYPE.names, task.result()):
+                matchups[field][scenario, pokemon1[chunk], pokemon2[chunk]] = values
+    return matchups
+
+
+def save_matchups(league, stat_table, matchups, rankings_version=None):
+    """
+    Atomically writes the matchups to the league's file for the stats
+    version and removes the files of older versions. Returns the path.
+    """
+    path = matchup_path(league, stat_table.version)
+    temp_path = f"{path}.tmp.npy"
+    np.save(temp_path, matchups)
+    os.replace(temp_path, path)
+
+    meta = {
+        'league': league,
+        'version': stat_table.version,
+        'rankings_version': rankings_version,
+        'shields': list(SHIELD_SCENARIOS),
+        'species_ids': list(stat_table.species_ids),
+        'created': time.time(),
+    }
+    with open(f"{path}.meta.json", 'w') as meta_file:
+        json.dump(meta, meta_file, indent=1)
+
+    for old_path in glob.glob(matchup_path(league, '*')):
+        if old_path != path and not old_path.endswith('.tmp.npy'):
+            os.remove(old_path)
+            if os.path.exists(f"{old_path}.meta.json"):
+                os.remove(f"{old_path}.meta.json")
+    return path
+
+
+def build_matchups(league, processes=None):
+    """
+    Simulates and stores the matchups of the league's current data, unless
+    they are already stored. Returns the path of the matchup file.
+    """
+    from team_building import MetaTeamDestroyer
+
+    team_maker = MetaTeamDestroyer(league=league)
+    stat_table = team_maker.stat_table
+    path = matchup_path(league, stat_table.version)
+    if os.path.exists(path):
+        return path
+    with span("matchup_matrix"):
+        matchups = simulate_matchups(stat_table, processes)
+    return save_matchups(league, stat_table, matchups, team_maker.rankings_version)
+
+
+def main():
+    from team_building import LEAGUE_RANKINGS
+
+    parser = argparse.ArgumentParser(description="Simulate and store every battle of the leagues")
+    parser.add_argument('leagues', nargs='*', default=list(LEAGUE_RANKINGS), help="Leagues (Default: all)")
+    parser.add_argument('--processes', type=int, default=None, help="Worker processes (Default: all cores)")
+    args = parser.parse_args()
+
+    for league in args.leagues:
+        start = time.perf_counter()
+        try:
+            path = build_matchups(league, args.processes)
+        except Exception as exc:
+            print(f"Failed to build the {league} matchups because: {exc}")
+            continue
+        print(f"{league}: {path} ({time.perf_counter() - start:.1f}s)")
+
+
+if __name__ == '__main__':
+    main()
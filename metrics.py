@@ -0,0 +1,132 @@
+"""
+Lightweight timing spans and cache counters
+
+    with span("records"):
+        ...
+    count_cache("league_model", hit=True)
+
+Every span adds its duration to a process-wide total per name and, while
+a request is being timed (start_request()), to that request's timings, so
+a slow page can be broken down into downloads, record filtering, counter
+aggregation, team building and battle simulation.
+Everything is exposed in the Prometheus text format by prometheus_text().
+"""
+
+import contextlib
+import functools
+import threading
+import time
+
+
+PREFIX = "team_builder"
+
+# {span name: [calls, seconds]}
+_SPANS = {}
+# {(counter name, ((label, value), ...)): total}
+_COUNTERS = {}
+_LOCK = threading.Lock()
+_REQUEST = threading.local()
+
+
+def record_span(name, seconds):
+    """ Adds a finished span to the totals and the current request """
+    with _LOCK:
+        totals = _SPANS.setdefault(name, [0, 0.0])
+        totals[0] += 1
+        totals[1] += seconds
+    timings = getattr(_REQUEST, 'timings', None)
+    if timings is not None:
+        totals = timings.setdefault(name, [0, 0.0])
+        totals[0] += 1
+        totals[1] += seconds
+
+
+@contextlib.contextmanager
+def span(name):
+    """ Times the block as the named span """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start)
+
+
+def timed(name):
+    """ Decorator timing every call of the function as the named span """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def increment(name, amount=1, **labels):
+    """ Adds amount to the named counter with the given labels """
+    key = (name, tuple(sorted(labels.items())))
+    with _LOCK:
+        _COUNTERS[key] = _COUNTERS.get(key, 0) + amount
+
+
+def count_cache(cache, hit):
+    """ Counts a hit or a miss of the named cache """
+    increment("cache_requests", cache=cache, result="hit" if hit else "miss")
+
+
+def start_request():
+    """ Starts collecting the spans of the current thread's request """
+    _REQUEST.timings = {}
+
+
+def end_request():
+    """
+    Stops collecting spans for the current request and returns
+    {span name: (calls, seconds)}
+    """
+    timings = getattr(_REQUEST, 'timings', None) or {}
+    _REQUEST.timings = None
+    return {name: tuple(totals) for name, totals in timings.items()}
+
+
+def reset():
+    """ Clears every span total and counter """
+    with _LOCK:
+        _SPANS.clear()
+        _COUNTERS.clear()
+
+
+def _labels(labels):
+    """ Returns the labels in the Prometheus text format """
+    if not labels:
+        return ""
+    text = ",".join([f'{label}="{str(value)}"' for label, value in labels])
+    return f"{{{text}}}"
+
+
+def prometheus_text():
+    """
+    Returns the span totals and counters in the Prometheus text format
+    """
+    with _LOCK:
+        spans = sorted([(name, list(totals)) for name, totals in _SPANS.items()])
+        counters = sorted(_COUNTERS.items())
+
+    lines = [
+        f"# HELP {PREFIX}_span_seconds Time spent in each phase",
+        f"# TYPE {PREFIX}_span_seconds summary",
+    ]
+    for name, (calls, seconds) in spans:
+        lines.append(f'{PREFIX}_span_seconds_sum{{span="{name}"}} {seconds:.6f}')
+        lines.append(f'{PREFIX}_span_seconds_count{{span="{name}"}} {calls}')
+
+    names = []
+    for (name, _), _ in counters:
+        if name not in names:
+            names.append(name)
+    for name in names:
+        lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+        for (counter_name, labels), value in counters:
+            if counter_name == name:
+                lines.append(f"{PREFIX}_{name}_total{_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
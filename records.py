@@ -0,0 +1,290 @@
+"""
+Battle records reported to gobattlelog
+
+The latest-large files hold every reported battle for a league and can be
+many MB, so records are parsed one at a time from the cached file.
+
+RecordStore keeps all of a league's records as integer-encoded numpy columns
+so they are parsed once and every meta view (num_reports/days_back/rating
+filters) is a mask and a bincount.
+MetaAggregates pre-aggregates those counts by (day, rating), cumulative
+over days, so the "last N days" counts of every rating are one prefix row.
+"""
+
+import codecs
+import json
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from http_cache import fetch, RECORDS_TTL
+from metrics import count_cache, span
+
+
+CHUNK_SIZE = 64 * 1024
+TEAM_SIZE = 3
+DAY = 24 * 60 * 60
+
+# Positions of the pokemon in a reported team
+LEAD, SAFESWAP, BACK = range(TEAM_SIZE)
+
+# {path: (version, RecordStore)} of record files already parsed
+_FILE_STORES = {}
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+
+def iter_json_array(chunks, key="records"):
+    """
+    Yields the items of a json array while it is being read.
+
+    The array can be the top level value or the value of `key` in a top level
+    object ({"records": [...]} from gobattlelog or [...] saved on disk).
+
+    :param chunks: Iterable of bytes/str pieces of the json document
+    :type chunks: iterable
+    :param key: The key of the array in a top level object (Default: "records")
+    :type key: str
+    """
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buffer, pos = "", 0
+    done = False
+
+    def read_more():
+        """ Appends the next chunk to the buffer, returns False at the end """
+        nonlocal buffer, pos, done
+        if done:
+            return False
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            buffer, pos = buffer[pos:] + utf8.decode(b'', final=True), 0
+            done = True
+            return False
+        if isinstance(chunk, bytes):
+            chunk = utf8.decode(chunk)
+        buffer, pos = buffer[pos:] + chunk, 0
+        return True
+
+    def next_char():
+        """ Skips whitespace and returns the next character ('' at the end) """
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in _WHITESPACE:
+                pos += 1
+            if pos < len(buffer):
+                return buffer[pos]
+            if not read_more():
+                return ''
+
+    def decode_value():
+        """ Decodes the next complete json value, reading more chunks as needed """
+        nonlocal pos
+        next_char()
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if read_more():
+                    continue
+                raise
+            # A number at the end of the buffer may continue in the next chunk
+            if end == len(buffer) and not done and read_more():
+                continue
+            pos = end
+            return value
+
+    # Find the start of the array
+    first = next_char()
+    if first == '{':
+        pos += 1
+        while True:
+            if next_char() == '}':
+                return
+            name = decode_value()
+            if next_char() != ':':
+                raise ValueError(f"Expected ':' after key {name!r}")
+            pos += 1
+            if name == key and next_char() == '[':
+                break
+            decode_value()
+            if next_char() == ',':
+                pos += 1
+    elif first != '[':
+        raise ValueError(f"Expected a json array or object, found {first!r}")
+    pos += 1
+
+    # Yield each item of the array
+    while True:
+        char = next_char()
+        if char == ']':
+            return
+        if char == ',':
+            pos += 1
+            continue
+        if char == '':
+            raise ValueError("Unexpected end of json array")
+        yield decode_value()
+
+
+def file_chunks(path):
+    """ Yields the file in chunks """
+    with open(path, 'rb') as records_file:
+        while True:
+            chunk = records_file.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+def _interned(ids, index, value):
+    """ Returns the integer id of the value, adding it to ids/index if new """
+    n = index.get(value)
+    if n is None:
+        n = index[value] = len(ids)
+        ids.append(value)
+    return n
+
+
+class RecordStore:
+    """
+    Battle records as numpy columns.
+
+    time and rating have one entry per record. species holds the
+    interned opponent species of each record as (lead, safe swap, back).
+    Only the columns the meta views count are kept.
+    """
+    def __init__(self, records):
+        """
+        :param records: Iterable of battle records
+        :type records: iterable
+        """
+        self.species_ids, self.species_index = [], {}
+
+        times, ratings, species = [], [], []
+        for record in records:
+            times.append(record.get('time'))
+            ratings.append(record.get('rating') or 0)
+
+            team = record.get('oppo_team', '').split('/')
+            team = team + ['?'] * (TEAM_SIZE - len(team))
+            for pokemon in team[:TEAM_SIZE]:
+                species.append(_interned(self.species_ids, self.species_index, pokemon.partition(':')[0]))
+
+        self.time = np.array(times, dtype=np.float64)
+        self.rating = np.array(ratings, dtype=np.int32)
+        self.species = np.array(species, dtype=np.int32).reshape(len(times), TEAM_SIZE)
+
+    def __len__(self):
+        return len(self.time)
+
+    def select(self, num_reports=None, days_back=None, rating=None):
+        """
+        Returns the row numbers of the records passing the filters, in the
+        order the records are counted (newest first when num_reports is set).
+
+        Keeps the num_reports most recent reports, then drops the ones older
+        than days_back or not at the given rating.
+
+        :param num_reports: The number of latest reports to check (Default: None)
+        :type num_reports: int
+        :param days_back: The number of days back to get data (Default: None)
+        :type days_back: int
+        :param rating: The (rounded) rating of the reports to keep (Default: None)
+        :type rating: int
+        """
+        if num_reports:
+            rows = np.argsort(-self.time, kind='stable')[:num_reports]
+        else:
+            rows = np.arange(len(self))
+
+        mask = np.ones(len(rows), dtype=bool)
+        if days_back:
+            cutoff = (datetime.now() - timedelta(days=days_back)).timestamp()
+            mask &= self.time[rows] >= cutoff
+        if rating:
+            mask &= self.rating[rows] == rating
+        return rows[mask]
+
+    def meta_list(self, rows, position):
+        """
+        Returns [(species, # of times reported), ...] at the position in the
+        rows, most reported first (ties in order of first report)
+        """
+        reported = self.species[rows, position]
+        counts = np.bincount(reported, minlength=len(self.species_ids))
+        species, first_rows = np.unique(reported, return_index=True)
+        order = np.lexsort((first_rows, -counts[species]))
+        return [(self.species_ids[species[n]], int(counts[species[n]])) for n in order]
+
+
+class MetaAggregates:
+    """
+    Meta counts of a RecordStore pre-aggregated into (day, rating) cells.
+
+    days are the distinct "days ago" of the records (0 is the last 24 hours
+    before now) and ratings the distinct ratings. counts[d, r, position]
+    holds how many times each species was reported at the position in
+    records at most days[d] days old at ratings[r], i.e. cumulative over
+    days, so the last N days are the single row rating_counts() returns.
+    first_rows holds the first such record of each species, to break ties
+    the same way as RecordStore.meta_list.
+    """
+    def __init__(self, store, now=None):
+        """
+        :param store: The records to aggregate
+        :type store: RecordStore
+        :param now: The time the days are counted back from (Default: now)
+        :type now: float
+        """
+        self.store = store
+        self.now = time.time() if now is None else now
+        days_ago = np.maximum(np.floor((self.now - store.time) / DAY), 0).astype(np.int64)
+        self.days, day_cells = np.unique(days_ago, return_inverse=True)
+        self.ratings, rating_cells = np.unique(store.rating, return_inverse=True)
+
+        shape = (len(self.days), len(self.ratings), TEAM_SIZE, len(store.species_ids))
+        cells = np.ravel_multi_index((
+            day_cells.reshape(-1, 1), rating_cells.reshape(-1, 1), np.arange(TEAM_SIZE).reshape(1, -1), store.species
+        ), shape).ravel()
+        counts = np.bincount(cells, minlength=int(np.prod(shape))).reshape(shape)
+        first_rows = np.full(int(np.prod(shape)), len(store), dtype=np.int32)
+        np.minimum.at(first_rows, cells, np.repeat(np.arange(len(store), dtype=np.int32), TEAM_SIZE))
+
+        self.counts = np.cumsum(counts, axis=0, dtype=np.int32)
+        self.first_rows = np.minimum.accumulate(first_rows.reshape(shape), axis=0)
+
+    def _day_row(self, days_back):
+        """ Returns the prefix row covering the last days_back days (-1 for none) """
+        if not days_back:
+            return len(self.days) - 1
+        return int(np.searchsorted(self.days, days_back, side='left')) - 1
+
+    def rating_counts(self, days_back=None):
+        """
+        Returns the counts and first_rows of the last days_back days for
+        every rating: two (ratings, TEAM_SIZE, species) arrays
+        """
+        last_row = self._day_row(days_back)
+        if last_row < 0:
+            shape = (len(self.ratings), TEAM_SIZE, len(self.store.species_ids))
+            return np.zeros(shape, dtype=self.counts.dtype), np.full(shape, len(self.store), dtype=np.int32)
+        return self.counts[last_row], self.first_rows[last_row]
+
+
+def load_record_store(url, path):
+    """
+    Returns the RecordStore of the cached copy of the url.
+    The file is only parsed again when its content changes.
+    """
+    resource = fetch(url, path, RECORDS_TTL)
+    cached = _FILE_STORES.get(path)
+    hit = cached is not None and cached[0] == resource.version
+    if not hit:
+        with span("records_parse"):
+            cached = _FILE_STORES[path] = (resource.version, RecordStore(iter_json_array(file_chunks(resource.path))))
+    count_cache("records", hit)
+    return cached[1]
@@ -0,0 +1,211 @@
+"""
+Battle stats and move damages of every ranked species of a league
+
+sim_battle used to look up each pokemon's default IVs, level and cp
+multiplier and recompute its attack, defense and hp on every battle.
+Those only depend on the league, the rankings and the gamemaster, so they
+are computed once per league into arrays (one row per ranked species) and
+the simulator only reads them.
+
+The same goes for move damage: the damage of each of every species'
+moveset moves (fast, charge 1, charge 2) on every other species is
+computed once as an (attacker, move, defender) tensor.
+"""
+
+import hashlib
+import threading
+
+import numpy as np
+
+from metrics import count_cache, span
+
+
+# Level and attack/defense/hp IVs used when a species has none for the league
+DEFAULT_IVS = [40, 15, 15, 15]
+# Fast, charge 1 and charge 2 columns of the moveset arrays
+MOVESET_SLOTS = 3
+STAB_MULTIPLIER = 1.2
+# PVPoke uses a bonus multiplier value. Not sure why..
+# https://github.com/pvpoke/pvpoke/blob/master/src/js/battle/Battle.js#L221
+BONUS_MULTIPLIER = 1.3
+
+# {league: StatTable} of the tables already built
+_STAT_TABLES = {}
+_LOCK = threading.Lock()
+
+
+class StatTable:
+    """
+    Effective attack, defense and hp, level and types of every ranked
+    species at its default IVs for the league, and the damage of its
+    moveset on every other ranked species
+    """
+    def __init__(self, league_cp, league_model, game_master, cp_multipliers, type_matrix):
+        """
+        :param league_cp: The league cp value (LEAGUE_VALUE)
+        :type league_cp: str
+        :param league_model: The league's counters and movesets
+        :type league_model: league_model.LeagueModel
+        :param game_master: The gamemaster
+        :type game_master: game_data.GameMaster
+        :param cp_multipliers: {level: cp multiplier}
+        :type cp_multipliers: dict
+        :param type_matrix: The type chart
+        :type type_matrix: game_data.TypeMatrix
+        """
+        self.league_cp = league_cp
+        self.league_model = league_model
+        self.game_master = game_master
+        self.cp_multipliers = cp_multipliers
+        self.type_matrix = type_matrix
+
+        species_ids, levels, ivs, base_stats, types = [], [], [], [], []
+        for species in league_model.all_pokemon:
+            pokemon = game_master.get_pokemon(species.species_id)
+            if pokemon is None:
+                continue
+            default_ivs = pokemon.get('defaultIVs', {}).get(f'cp{league_cp}', DEFAULT_IVS)
+            species_ids.append(species.species_id)
+            levels.append(default_ivs[0])
+            ivs.append(default_ivs[1:])
+            base_stats.append([pokemon['baseStats']['atk'], pokemon['baseStats']['def'], pokemon['baseStats']['hp']])
+            types.append(tuple(pokemon.get('types', [])))
+
+        self.species_ids = tuple(species_ids)
+        self.index = {species_id: n for n, species_id in enumerate(self.species_ids)}
+        self.types = tuple(types)
+        self.level = np.array(levels, dtype=np.float64)
+        self.ivs = np.array(ivs, dtype=np.int64).reshape(len(species_ids), 3)
+        self.cpm = np.array([cp_multipliers[level] for level in levels], dtype=np.float64)
+
+        # Same operations as the per battle stat calculation so the stats match exactly
+        base_stats = np.array(base_stats, dtype=np.int64).reshape(len(species_ids), 3)
+        self.atk = (base_stats[:, 0] + self.ivs[:, 0]).astype(np.float64) * self.cpm
+        self.defense = (base_stats[:, 1] + self.ivs[:, 1]).astype(np.float64) * self.cpm
+        self.hp = np.floor((base_stats[:, 2] + self.ivs[:, 2]) * self.cpm).astype(np.int64)
+
+        self.movesets = tuple([league_model.species_moveset_dict[species_id] for species_id in self.species_ids])
+        self.damage = self.damage_tensor()
+
+        # Energy gained by the fast move and cost of each charge move, fast move cooldown (ms)
+        # and whether the whole moveset is in the gamemaster
+        self.energy = np.zeros((len(species_ids), MOVESET_SLOTS), dtype=np.int64)
+        self.cooldown = np.zeros(len(species_ids), dtype=np.int64)
+        self.complete = np.zeros(len(species_ids), dtype=bool)
+        for row, moveset in enumerate(self.movesets):
+            moves = [self.game_master.get_move(move_id) for move_id in moveset[:MOVESET_SLOTS]]
+            if len(moves) < MOVESET_SLOTS or None in moves:
+                continue
+            self.energy[row] = [moves[0]['energyGain'], moves[1]['energy'], moves[2]['energy']]
+            self.cooldown[row] = moves[0]['cooldown']
+            self.complete[row] = True
+
+        for array in [self.level, self.ivs, self.cpm, self.atk, self.defense, self.hp, self.damage,
+                      self.energy, self.cooldown, self.complete]:
+            array.flags.writeable = False
+
+        # Content hash of everything a battle depends on, so stored battle results
+        # can be matched to the stats they were simulated with
+        content = hashlib.sha1("\n".join(self.species_ids).encode())
+        for array in [self.atk, self.hp, self.damage, self.energy, self.cooldown, self.complete]:
+            content.update(array.tobytes())
+        self.version = content.hexdigest()[:12]
+
+    def __getstate__(self):
+        """ Pickles only the tables (for worker processes), not the data they were built from """
+        state = dict(self.__dict__)
+        state.update({'league_model': None, 'game_master': None, 'cp_multipliers': None, 'type_matrix': None})
+        return state
+
+    def damage_tensor(self):
+        """
+        Returns the (attacker, move slot, defender) int16 damages of every
+        species' fast, charge 1 and charge 2 moves on every species.
+        Moves missing from the moveset or the gamemaster do no damage.
+        """
+        n = len(self.species_ids)
+        matrix = self.type_matrix
+        power = np.zeros((n, MOVESET_SLOTS))
+        stab = np.ones((n, MOVESET_SLOTS))
+        move_types = np.full((n, MOVESET_SLOTS), -1, dtype=np.intp)
+        for row, (moveset, types) in enumerate(zip(self.movesets, self.types)):
+            for slot, move_id in enumerate(moveset[:MOVESET_SLOTS]):
+                move = self.game_master.get_move(move_id)
+                if move is None:
+                    continue
+                power[row, slot] = float(move.get('power'))
+                move_types[row, slot] = matrix.index[move.get('type').lower()]
+                if move.get('type') in types:
+                    stab[row, slot] = STAB_MULTIPLIER
+
+        # Effectiveness of every attacking type on each species' types
+        type_indexes = np.array([
+            [matrix.index.get(t.lower(), matrix.none_index) for t in types[:2]] + [matrix.none_index] * (2 - len(types[:2]))
+            for types in self.types
+        ], dtype=np.intp).reshape(n, 2)
+        type_effectiveness = matrix.weakness_vectors(type_indexes)
+        effectiveness = type_effectiveness[:, np.maximum(move_types, 0)].transpose(1, 2, 0)
+
+        # Same operation order as the scalar damage formula so the floors match
+        damage = 0.5 * power[:, :, None] * self.atk[:, None, None] / self.defense[None, None, :]
+        damage = damage * stab[:, :, None] * effectiveness * BONUS_MULTIPLIER
+        damage = np.floor(damage).astype(np.int16) + 1
+        damage[move_types < 0] = 0
+        return damage
+
+    def rows(self, species_ids):
+        """ Returns the rows of the species as an array (KeyError if one isn't ranked) """
+        return np.array([self.index[species_id] for species_id in species_ids], dtype=np.intp)
+
+    def move_damages(self, attacker, defender):
+        """
+        Returns the damage of the attacker's moveset moves on the defender
+        as {moveId: damage}
+        """
+        damages = self.damage[self.index[attacker], :, self.index[defender]]
+        return {move_id: int(damages[slot]) for slot, move_id in enumerate(self.movesets[self.index[attacker]][:MOVESET_SLOTS])}
+
+    def row(self, species_id):
+        """ Returns the row of the species (KeyError if it isn't ranked) """
+        return self.index[species_id]
+
+    def stats(self, species_id):
+        """ Returns the (atk, def, hp) of the species """
+        row = self.index[species_id]
+        return float(self.atk[row]), float(self.defense[row]), int(self.hp[row])
+
+
+def load_stat_table(league, league_cp, league_model, game_master, cp_multipliers, type_matrix):
+    """
+    Returns the StatTable of the league.
+    Only built again when the rankings, gamemaster, cp multipliers or type chart change.
+
+    :param league: The league
+    :type league: str
+    :param league_cp: The league cp value (LEAGUE_VALUE)
+    :type league_cp: str
+    :param league_model: The league's counters and movesets
+    :type league_model: league_model.LeagueModel
+    :param game_master: The gamemaster
+    :type game_master: game_data.GameMaster
+    :param cp_multipliers: {level: cp multiplier}
+    :type cp_multipliers: dict
+    :param type_matrix: The type chart
+    :type type_matrix: game_data.TypeMatrix
+    """
+    def current(table):
+        return (
+            table is not None and table.league_cp == league_cp and table.league_model is league_model
+            and table.game_master is game_master and table.cp_multipliers is cp_multipliers
+            and table.type_matrix is type_matrix
+        )
+
+    table = _STAT_TABLES.get(league)
+    hit = current(table)
+    if not hit:
+        with _LOCK, span("stat_table"):
+            table = _STAT_TABLES.get(league)
+            if not current(table):
+                table = _STAT_TABLES[league] = StatTable(league_cp, league_model, game_master, cp_multipliers, type_matrix)
+    count_cache("stat_table", hit)
+    return table
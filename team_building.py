@@ -27,11 +27,20 @@
      - https://pvpoke.com/battle/1500/{pokemon1}/{pokemon2}/{#shields1}{#shields2}
 """
 
-import json
+import copy
 import random
+import time
+import numpy as np
 import requests
-from datetime import datetime, timedelta
-from collections import defaultdict
+
+from game_data import GAME_MASTER_FILE, GAME_MASTER_URL, load_game_master, type_chart, type_matrix, cp_multipliers
+from http_cache import fetch_all, GAME_MASTER_TTL, RANKINGS_TTL, RECORDS_TTL
+from league_model import load_league_model
+from metrics import count_cache, span
+from records import load_record_store, MetaAggregates, LEAD, SAFESWAP, BACK
+from stat_table import load_stat_table
+from team_sampling import LeadTeamSampler, PairSampler, SafeswapTeamSampler
+from team_search import TeamSearch, BEAM_WIDTH
 
 
 # The number of pokemon to consider
@@ -39,6 +48,10 @@ TOP_TEAM_NUM = None
 MIN_COUNTERS = 25
 TOP_PERCENT = 1
 REQUEST_TIMEOUT = 180
+# How long (seconds) loaded league data is reused for other days/ratings
+DATA_TTL = 10 * 60
+# Most leagues downloaded at once by warm_leagues
+WARM_WORKERS = 4
 
 LEAGUE_RANKINGS = {
     "ULP": "https://vps.gobattlelog.com/data/overall/rankings-2500-premier.json?v=1.25.10",
@@ -110,31 +123,58 @@ CUP_VALUE = {
     'Love': 'love'
 }
 
-# https://gamepress.gg/pokemongo/cp-multiplier
-HIGH_MULTIPLIERS = {
-    45.5: 0.81779999,
-    46: 0.82029999,
-    46.5: 0.82279999,
-    47: 0.82529999,
-    47.5: 0.82779999,
-    48: 0.83029999,
-    48.5: 0.83279999,
-    49: 0.83529999,
-    49.5: 0.83779999,
-    50: 0.84029999,
-    50.5: 0.84279999,
-    51: 0.84529999
-}
-
 class NoPokemonFound(Exception):
     pass
 
+
+def latest_records_url(league):
+    """ Returns the url of the league's latest-large records """
+    return LEAGUE_DATA.get(league).replace('latest', 'latest-large')
+
+
+def league_resources(league):
+    """
+    Returns the (url, path, ttl) of the rankings, gamemaster and records the league uses
+    """
+    return [
+        (LEAGUE_RANKINGS.get(league), f"data/rankings_{league}.json", RANKINGS_TTL),
+        (GAME_MASTER_URL, GAME_MASTER_FILE, GAME_MASTER_TTL),
+        (latest_records_url(league), f"data/latest_{league}.json", RECORDS_TTL),
+    ]
+
+
+def warm_leagues(leagues=None, max_workers=WARM_WORKERS):
+    """
+    Fetches the data of every league (Default: all of LEAGUE_RANKINGS) in parallel
+    with at most max_workers downloads at a time.
+    Returns {league: error} for the leagues that failed.
+    """
+    leagues = [league for league in (leagues or LEAGUE_RANKINGS) if league in LEAGUE_DATA]
+    resources = {}
+    for league in leagues:
+        for resource in league_resources(league):
+            resources.setdefault(resource[1], resource)
+
+    results = dict(zip(resources, fetch_all(list(resources.values()), max_workers=max_workers, raise_errors=False)))
+    errors = {}
+    for league in leagues:
+        for _, path, _ in league_resources(league):
+            if isinstance(results[path], Exception):
+                errors[league] = results[path]
+    return errors
+
+def round_rating(rating):
+    """ Returns the rating rounded to the nearest 100 (None for all ratings) """
+    if rating:
+        return int(round(rating/1000., 1)*1000)
+    return None
+
 class TeamCreater:
     def __init__(self, team_maker):
-        self.types = requests.get("https://pogoapi.net//api/v1/type_effectiveness.json").json()
-        cp_multipliers = requests.get("https://pogoapi.net//api/v1/cp_multiplier.json").json()
-        self.cp_multipliers = {cpm['level']:cpm['multiplier'] for cpm in cp_multipliers}
-        self.cp_multipliers.update(HIGH_MULTIPLIERS)
+        # Shared per-process tables loaded from the pogoapi snapshots in data/
+        self.types = type_chart()
+        self.type_matrix = type_matrix()
+        self.cp_multipliers = cp_multipliers()
         self.team_maker = team_maker
 
     def get_effectiveness(self, attacker_type, defender_types):
@@ -147,28 +187,32 @@ class TeamCreater:
 
     def get_weaknesses(self, pokemon):
         """ Returns the type weaknesses of a given pokemon """
-        weaks = {}
-        for p in self.team_maker.game_master.get('pokemon'):
-            if p.get('speciesId') != pokemon:
-                continue
-            pokemon_types = p.get('types')
-
-            weaknesses = set()
-            weaknesses_dict = defaultdict(lambda: 1)
-            for t in pokemon_types:
-                if t == 'none':
-                    continue
-                for chart_type, chart_effectiveness in self.types.items():
-                    type_effectiveness = chart_effectiveness[t.capitalize()]
-                    # Type effectiveness is a multiplier value
-                    weaknesses_dict[chart_type] *= type_effectiveness
-
-                    if chart_effectiveness[t.capitalize()] > 1:
-                        weaknesses.add(chart_type.lower())
-            weaks = {x:y for x,y in weaknesses_dict.items() if y>1.0}
-            #print(f"{pokemon} is weak to {weaknesses}")
-            #print(f"{pokemon} weaknesses: {weaks}")
-        return weaks
+        game_master = self.team_maker.game_master
+        row = game_master.species_index.get(pokemon)
+        if row is None:
+            return {}
+        vectors, _ = game_master.weakness_table(self.type_matrix)
+        return {
+            name: float(vectors[row, n]) for n, name in enumerate(self.type_matrix.names) if vectors[row, n] > 1.0
+        }
+
+    def weakness_masks(self, pokemon_list):
+        """
+        Returns the type weakness bitmask of each pokemon in the list
+        (0 for pokemon missing from the game master)
+        """
+        game_master = self.team_maker.game_master
+        _, masks = game_master.weakness_table(self.type_matrix)
+        rows = np.array([game_master.species_index.get(p, -1) for p in pokemon_list], dtype=np.intp)
+        return np.where(rows >= 0, masks[rows], 0).astype(np.uint32)
+
+    def shares_weaknesses(self, pokemon_list, pokemon):
+        """
+        Returns a bool array of which pokemon in the list share at least one
+        type weakness with the given pokemon
+        """
+        pokemon_mask = self.weakness_masks([pokemon])[0]
+        return (self.weakness_masks(pokemon_list) & pokemon_mask) != 0
 
 class MetaTeamDestroyer:
     """
@@ -185,112 +229,99 @@ class MetaTeamDestroyer:
         :param num_reports: The number of latest reports to check (Default: None)
         :type num_reports: int
         """
-        # Initialize all of the data
-        rankings_url = LEAGUE_RANKINGS.get(league)
-        latest_url = LEAGUE_DATA.get(league)
         self.result_data = {}
-
-        # Get the latest-large data
-        latest_url = latest_url.replace('latest', 'latest-large')
         self.league = league
         self.league_cp = LEAGUE_VALUE[league]
 
-        try:
-            self.all_pokemon = requests.get(rankings_url, timeout=REQUEST_TIMEOUT).json()
-            json.dump(self.all_pokemon, open("data/pokemon_rankings.json", 'w'))
-        except Exception as exc:
-            print(f"Failed to load ranking data because: {exc}")
-            self.all_pokemon = json.load(open("data/pokemon_rankings.json"))
-
-        try:
-            self.game_master = requests.get("https://vps.gobattlelog.com/data/gamemaster.json?v=1.25.10", timeout=REQUEST_TIMEOUT).json()
-            json.dump(self.game_master, open("game_master.json"))
-        except Exception as exc:
-            print(f"Failed to load game master data because: {exc}")
-            self.game_master = json.load(open("game_master.json"))
-
-        try:
-            self.latest_info = requests.get(latest_url, timeout=REQUEST_TIMEOUT).json().get("records")
-            json.dump(self.latest_info, open(f"data/latest_{league}.json", 'w'))
-        except Exception as exc:
-            print(f"Failed to load latest data because: {exc}")
-            self.all_pokemon = json.load(open(f"data/latest_{league}.json"))
-
-        # Sort reports by time and get last X teams
-        sorted_latest_info = sorted(self.latest_info, key=lambda x: x.get('time'), reverse=True)
-        if num_reports:
-            if len(sorted_latest_info) > num_reports - 1:
-                self.latest_info = sorted_latest_info[:num_reports]
-            else:
-                self.latest_info = sorted_latest_info
+        # Fetch the rankings, gamemaster and latest-large data concurrently.
+        # The data files are kept up to date by the http cache
+        with span("download"):
+            rankings, _, _ = fetch_all(league_resources(league))
+
+        # The counters, weaknesses and movesets only depend on the rankings, so
+        # they are built once per rankings version and shared by every team maker
+        self.league_model = load_league_model(league, rankings)
+        self.rankings_version = self.league_model.version
+        self.all_pokemon = self.league_model.all_pokemon
+        self.species_counters_dict = self.league_model.species_counters_dict# pokemon that each pokemon counters well
+        self.species_weaknesses_dict = self.league_model.species_weaknesses_dict# pokemon that each pokemon is weak to
+        self.species_moveset_dict = self.league_model.species_moveset_dict
+        self.species_ids = self.league_model.species_ids
+        self.species_index = self.league_model.species_index
+        self.counter_matrix = self.league_model.counter_matrix
+
+        self.game_master = load_game_master()
+
+        # Battle stats and move damages of the ranked species at the league's default IVs
+        self.stat_table = load_stat_table(
+            league, self.league_cp, self.league_model, self.game_master, cp_multipliers(), type_matrix()
+        )
 
-        # Round the rating if one is provided
-        if rating:
-            rating = int(round(rating/1000., 1)*1000)
+        # Parse the latest reports once into columns and pre-aggregate them by day and rating
+        self.records = load_record_store(latest_records_url(league), f"data/latest_{league}.json")
+        with span("aggregate"):
+            self.aggregates = MetaAggregates(self.records)
+        self.loaded_time = time.time()
 
+        # Create common leads and backlines lists
+        self._meta_by_rating = {}
+        self.leads_list, self.safeswaps_list, self.backs_list = self.get_meta_lists(rating, days_back, num_reports)
 
-        # Filter out values based on date and rating
-        temp_latest_info = []
-        if days_back or rating:
-            for record in self.latest_info:
-                if days_back:
-                    if datetime.fromtimestamp(record.get('time')) < datetime.now() - timedelta(days=days_back):
-                        continue
-                if rating:
-                    if record.get('rating') != rating:
-                        continue
-                temp_latest_info.append(record)
-            self.latest_info = temp_latest_info
+        # Team distributions of recommend_teams. The back pokemon of a lead
+        # don't depend on the meta lists so meta views share them
+        self._team_samplers = {}
+        self._back_samplers = {}
+        self._team_search = None
 
-        if len(self.latest_info) == 0:
-            raise NoPokemonFound(f"Did not find {league} data last {days_back} days at {rating or 'all'} rating")
-                    
+    def get_meta_lists(self, rating=None, days_back=None, num_reports=None):
+        """
+        Returns the (leads, safe swaps, backs) lists of the last num_reports
+        teams reported in the last days_back days at the rating
+        """
+        if not num_reports:
+            # Every rating of the window is counted at once
+            return self.meta_by_rating(days_back).meta_lists(rating)
 
+        # Only the last num_reports teams need the records themselves
+        rating = round_rating(rating)
+        rows = self.records.select(num_reports=num_reports, days_back=days_back, rating=rating)
+        meta_lists = [self.records.meta_list(rows, position) for position in [LEAD, SAFESWAP, BACK]]
 
-        # Create common leads and backlines lists
-        leads = defaultdict(int)
-        safeswaps = defaultdict(int)
-        backs = defaultdict(int)
-        for record in self.latest_info:
-            if rating and record.get("rating") != rating:
-                continue
-            team = record.get("oppo_team")
-            pokemon = team.split('/')
-            leads[pokemon[0].split(':')[0]] += 1
-            safeswaps[pokemon[1].split(':')[0]] += 1
-            backs[pokemon[2].split(':')[0]] += 1
-
-        self.leads_list = sorted(list(leads.items()), key=lambda x: x[1], reverse=True)
-        self.safeswaps_list = sorted(list(safeswaps.items()), key=lambda x: x[1], reverse=True)
-        self.backs_list = sorted(list(backs.items()), key=lambda x: x[1], reverse=True)
+        if not meta_lists[0]:
+            raise NoPokemonFound(f"Did not find {self.league} data last {days_back} days at {rating or 'all'} rating")
 
         # Remove pokemon not in the top TOP_PERCENT from the leads
         if TOP_PERCENT:
-            self.leads_list = self.filter_top_pokemon(self.leads_list)
-            self.safeswaps_list = self.filter_top_pokemon(self.safeswaps_list)
-            self.backs_list = self.filter_top_pokemon(self.backs_list)
-        
+            meta_lists = [self.filter_top_pokemon(meta_list) for meta_list in meta_lists]
+        return meta_lists
 
-        # Create a mapping of the counters
-        self.species_counters_dict = defaultdict(set)# pokemon that each pokemon counters well
-        self.species_weaknesses_dict = defaultdict(set)# pokemon that each pokemon is weak to
-        self.species_moveset_dict = defaultdict(list)
-        for species in self.all_pokemon:
-            counters = species.get('counters')
-            matchups = species.get('matchups')
-            species_id = species.get('speciesId')
-            self.species_counters_dict[species_id].update([c.get('opponent') for c in counters])
-            self.species_weaknesses_dict[species_id].update([m.get('opponent') for m in matchups])
-
-            # Add the species as counters to the matchups
-            for matchup in matchups:
-                self.species_counters_dict[matchup.get('opponent')].add(species_id)
-
-            for counter in counters:
-                self.species_weaknesses_dict[counter.get('opponent')].add(species_id)
-        
-            # Add the movesets
-            self.species_moveset_dict[species.get('speciesId')] = species.get('moveset')
+    def meta_by_rating(self, days_back=None):
+        """
+        Returns the MetaByRating of the last days_back days.
+        Built once per days_back and shared by the meta views.
+        """
+        meta = self._meta_by_rating.get(days_back)
+        count_cache("meta_by_rating", meta is not None)
+        if meta is None:
+            with span("meta_by_rating"):
+                meta = self._meta_by_rating[days_back] = MetaByRating(self, days_back)
+        return meta
+
+    def meta_view(self, rating=None, days_back=None, num_reports=None):
+        """
+        Returns a copy of this team maker for the given filters.
+        Shares all of the loaded data, so nothing is downloaded or parsed again.
+        """
+        view = copy.copy(self)
+        view.leads_list, view.safeswaps_list, view.backs_list = self.get_meta_lists(rating, days_back, num_reports)
+        view.result_data = {}
+        view._team_samplers = {}
+        view._team_search = None
+        return view
+
+    def is_stale(self):
+        """ Returns True if the loaded data is older than DATA_TTL """
+        return time.time() - self.loaded_time > DATA_TTL
 
     @staticmethod
     def filter_top_pokemon(pokemon_list):
@@ -308,12 +339,9 @@ class MetaTeamDestroyer:
         league_cp = LEAGUE_VALUE.get(league, '1500').split('-')[0]
         if league_cp == '10000':
             return '15-15-15'
-        for pokemon_info in self.game_master.get('pokemon'):
-            if pokemon_info.get('speciesId') == pokemon:
-                print(pokemon_info.get('defaultIVs'))
-                print(league_cp)
-                print(pokemon_info.get('defaultIVs').get(f'cp{league_cp}', 'cp1500'))
-                return '-'.join([str(n) for n in pokemon_info.get('defaultIVs').get(f'cp{league_cp}', 'cp1500')[1:]])
+        pokemon_info = self.game_master.get_pokemon(pokemon)
+        if pokemon_info:
+            return '-'.join([str(n) for n in pokemon_info.get('defaultIVs').get(f'cp{league_cp}', 'cp1500')[1:]])
 
     def get_counters(self, pokemon_name):
         """
@@ -324,7 +352,19 @@ class MetaTeamDestroyer:
         # Simulate battles against ALL pokemon
         #for pokemon in self.all_pokemon:
         #    simulate_battle(pokemon.get('speciesId'), pokemon_name)
-        return self.species_counters_dict[pokemon_name]
+        return self.species_counters_dict.get(pokemon_name, frozenset())
+
+    def meta_frequencies(self, pokemon_list):
+        """
+        Returns the # of times each species (ordered as species_ids) was
+        reported in the list [('mon1', # of times reported) ...]
+        """
+        frequencies = np.zeros(len(self.species_ids), dtype=np.float32)
+        for pokemon in pokemon_list:
+            row = self.species_index.get(pokemon[0])
+            if row is not None:
+                frequencies[row] += pokemon[1]
+        return frequencies
 
     def get_reccommended_counters(self, pokemon_list):
         """ Returns recommended counters to the list of pokemon """
@@ -334,28 +374,16 @@ class MetaTeamDestroyer:
 
         # Get counters to the common leads
         # pokemon_list = [('mon1', # of times reported) ...]
-        # counter_leads = [['mon1', 'mon2' ..], ...]
-        counter_leads = []
-        total_reported_pokemon = 0
-        for lead in pokemon_list:
-            #counters = list(self.get_counters(lead[0]))
-            
-            #counters = self.get_counters(lead[0])
-            counters = list(self.get_counters(lead[0])) * lead[1]
-            counter_leads.append(counters)
+        frequencies = self.meta_frequencies(pokemon_list)
+        total_reported_pokemon = sum([lead[1] for lead in pokemon_list])
 
-            total_reported_pokemon += lead[1]
-
-        # Get the most common pokemon from the counters
-        counter_counts = defaultdict(int)
-        for counters in counter_leads:
-            for counter in counters:
-                counter_counts[counter] += 1
+        # Number of reported pokemon that each species counters
+        counter_totals = frequencies @ self.counter_matrix
 
         # Convert counts to percents
-        for count in counter_counts:
-            #counter_counts[count] = 100.*counter_counts[count] / float(len(pokemon_list))
-            counter_counts[count] = 100.*counter_counts[count] / float(total_reported_pokemon)
+        counter_counts = {}
+        for n in np.flatnonzero(counter_totals):
+            counter_counts[self.species_ids[n]] = 100.*float(counter_totals[n]) / float(total_reported_pokemon)
 
         # Get the counters in the form of
         #  [('p1', #,), ('p2', #), ...]
@@ -370,20 +398,8 @@ class MetaTeamDestroyer:
         """
         Returns the moveset string for the pvpoke url based on the moveset
         """
-        moves = []
-        for pokemon in self.game_master.get("pokemon"):
-            if pokemon["speciesId"] == pokemon_name:
-                # fast move
-                for n, move in enumerate(pokemon['fastMoves']):
-                    if move == moveset[0]:
-                        moves.append(str(n))
-            
-                # charged moves
-                for move in moveset[1:]:
-                    for n, m in enumerate(pokemon['chargedMoves']):
-                        if m == move:
-                            moves.append(str(n+1))
-        return '-'.join(moves)
+        moves = self.game_master.moveset_positions(pokemon_name, moveset)
+        return '-'.join([str(n) for n in moves])
 
 
     def simulate_battle(pokemon1, pokemon2, n_shields=1):
@@ -391,31 +407,39 @@ class MetaTeamDestroyer:
         last numbers are the movesets..
         to get default movesets use pvpoke rankings and the game master to get the numbers
         """
-        moveset1 = self.species_moveset_dict[pokemon1]
-        moveset2 = self.species_moveset_dict[pokemon2]
+        moveset1 = self.species_moveset_dict.get(pokemon1, ())
+        moveset2 = self.species_moveset_dict.get(pokemon2, ())
         moveset_str1 = self.get_moveset_string(pokemon1, moveset1)
         moveset_str2 = self.get_moveset_string(pokemon2, moveset2)
         url = f"https://pvpoke.com/battle/2500/{pokemon1}/{pokemon2}/${n_shields}${n_shields}/{moveset_str1}/{moveset_str2}/"
         requests.get(url)
         pass
 
-    def choose_weighted_pokemon(self, pokemon_list, n=1):
+    @staticmethod
+    def preferred_pokemon(pokemon_list):
         """
-        Chooses pokemon from the list [(p1, #), (p2, #), ...]
+        Returns which pokemon in the list [(p1, #), (p2, #), ...] counter enough
+        pokemon (MIN_COUNTERS) to be picked
         """
-        weights, pokemons = [], []
-        for pokemon in pokemon_list:
-            # Skip any pokemon which don't counter enough pokemon
-            if MIN_COUNTERS and pokemon[1] < MIN_COUNTERS:
-                continue
+        return [not (MIN_COUNTERS and pokemon[1] < MIN_COUNTERS) for pokemon in pokemon_list]
 
-            pokemons.append(pokemon[0])
-            weights.append(pokemon[1])
+    def weighted_pokemon(self, pokemon_list):
+        """
+        Returns the pokemon and weights picked from in the list [(p1, #), (p2, #), ...]
+        """
+        preferred = self.preferred_pokemon(pokemon_list)
+        # Use all pokemon if none counter enough pokemon
+        if not any(preferred):
+            preferred = [True] * len(pokemon_list)
+        pokemons = [pokemon[0] for pokemon, keep in zip(pokemon_list, preferred) if keep]
+        weights = [pokemon[1] for pokemon, keep in zip(pokemon_list, preferred) if keep]
+        return pokemons, weights
 
-        # Return all pokemon if none counter enough pokemon
-        if not pokemons:
-            pokemons = [pokemon[0] for pokemon in pokemon_list]
-            weights = [pokemon[1] for pokemon in pokemon_list]
+    def choose_weighted_pokemon(self, pokemon_list, n=1):
+        """
+        Chooses pokemon from the list [(p1, #), (p2, #), ...]
+        """
+        pokemons, weights = self.weighted_pokemon(pokemon_list)
         try:
             random_pokemons = random.choices(pokemons, weights=weights, k=n)
         except Exception as exc:
@@ -437,53 +461,200 @@ class MetaTeamDestroyer:
         random_counter = self.choose_weighted_pokemon(lead_counters)[0]
         return self.build_team_from_pokemon(random_counter)
 
-    def build_safeswap_team(self, pokemon):
+    def recommend_teams(self, n, position="lead", chosen_pokemon=None):
         """
-        Builds a team with the given pokemon in the back
-        Note: squares the weights for more weight on common pokemon
+        Returns up to n distinct teams picked like recommend_team.
+        Fewer are only returned when fewer teams are possible.
+
+        :param n: The number of teams
+        :type n: int
+        :param position: The position of the chosen pokemon, 'lead' or 'back' (Default: "lead")
+        :type position: str
+        :param chosen_pokemon: The pokemon to build the teams around (Default: a random lead)
+        :type chosen_pokemon: str
+
+        :return: the (results, team) of each team
+        :rtype: list
         """
-        # Determine pokemon weakness typings
+        with span("team_sampler"):
+            sampler = self.team_sampler(position, chosen_pokemon)
+        if not sampler.count():
+            raise NoPokemonFound(f"No teams can be made for {chosen_pokemon or 'the meta leads'} in {self.league}")
+
+        # Seeded from `random` so random.seed() also repeats these teams
+        rng = np.random.default_rng(random.getrandbits(64))
+        with span("recommend_teams"):
+            return [
+                self.team_results(list(team), chosen_pokemon or team[0])
+                for team in sampler.sample(n, rng)
+            ]
+
+    def team_sampler(self, position="lead", chosen_pokemon=None):
+        """
+        Returns the TeamSampler of recommend_team(chosen_pokemon, position).
+        The weights are only worked out the first time.
+        """
+        if chosen_pokemon and position not in ['lead', 'back']:
+            chosen_pokemon = None
+        key = (position if chosen_pokemon else 'lead', chosen_pokemon)
+        sampler = self._team_samplers.get(key)
+        count_cache("team_sampler", sampler is not None)
+        if sampler is not None:
+            return sampler
+
+        if chosen_pokemon and position == 'back':
+            weak_list, strong_list = self.safeswap_candidates(chosen_pokemon)
+            sampler = SafeswapTeamSampler(
+                chosen_pokemon,
+                [p for p, _ in weak_list], [w for _, w in weak_list],
+                [p for p, _ in strong_list], [w for _, w in strong_list]
+            )
+        else:
+            if chosen_pokemon:
+                leads, lead_weights = [chosen_pokemon], [1]
+            else:
+                lead_counters = self.get_reccommended_counters(self.leads_list)
+                leads, lead_weights = self.weighted_pokemon(lead_counters)
+
+            backs, kept = [], []
+            for lead, weight in zip(leads, lead_weights):
+                back = self.back_pair_sampler(lead)
+                if back[1].count():
+                    backs.append(back)
+                    kept.append((lead, weight))
+            sampler = LeadTeamSampler([p for p, _ in kept], [w for _, w in kept], backs)
+
+        self._team_samplers[key] = sampler
+        return sampler
+
+    def search_teams(self, k=10, beam_width=BEAM_WIDTH, lead=None):
+        """
+        Returns the k teams that handle the most of the current meta,
+        searching the beam_width best leads (None for all of them).
+
+        :param k: The number of teams (Default: 10)
+        :type k: int
+        :param beam_width: The number of best leads searched (Default: BEAM_WIDTH)
+        :type beam_width: int
+        :param lead: Only search teams with this lead (Default: None)
+        :type lead: str
+
+        :return: the [(score, [lead, safe swap, back]), ...] of the best teams
+        :rtype: list
+        """
+        with span("team_search"):
+            search = self.team_search()
+            if lead and lead not in search.candidates:
+                raise NoPokemonFound(f"{lead} can't be on a team in {self.league}")
+            return [(score, list(team)) for score, team in search.search(k, beam_width, [lead] if lead else None)]
+
+    def best_teams(self, k=10, beam_width=BEAM_WIDTH, lead=None):
+        """
+        Returns the (results, team) of the k best teams from search_teams
+        """
+        return [self.team_results(team, team[0]) for _, team in self.search_teams(k, beam_width, lead)]
+
+    def team_search(self):
+        """
+        Returns the TeamSearch of the current meta lists
+        """
+        if self._team_search is not None:
+            return self._team_search
+
+        # Every ranked pokemon can be on a team
+        candidates = [p for p in self.species_ids if p in self.species_moveset_dict]
+        candidate_rows = [self.species_index[p] for p in candidates]
+
+        # Weight each meta list equally
+        meta_lists = [self.leads_list, self.safeswaps_list, self.backs_list]
+        frequencies = [self.meta_frequencies(meta_list) for meta_list in meta_lists]
+        shares = [f / f.sum() if f.sum() else f for f in frequencies]
+        meta = np.flatnonzero(sum(shares))
+        meta_weights = sum(shares)[meta] / len([f for f in frequencies if f.sum()])
+
+        # covers[c, m] when candidate c is a counter of meta pokemon m
+        covers = self.counter_matrix[np.ix_(meta, candidate_rows)].T > 0
         tc = TeamCreater(self)
-        ss_type_weaknesses = tc.get_weaknesses(pokemon)
+        self._team_search = TeamSearch(
+            candidates, covers, meta_weights, shares[0][meta], tc.weakness_masks(candidates), shares[1][meta]
+        )
+        return self._team_search
+
+    def back_pair_sampler(self, pokemon):
+        """
+        Returns the back pokemon candidates of the lead and a PairSampler
+        picking two of them like build_team_from_pokemon.
+        Only depends on the league model, so it is shared by every meta view.
+        """
+        back = self._back_samplers.get(pokemon)
+        if back is None:
+            counter_counters = self.back_candidates(pokemon)
+            back = (
+                [c[0] for c in counter_counters],
+                PairSampler([c[1] for c in counter_counters], self.preferred_pokemon(counter_counters))
+            )
+            self._back_samplers[pokemon] = back
+        return back
+
+    def safeswap_candidates(self, pokemon):
+        """
+        Returns the pokemon picked from for the front and back of a team with
+        the given pokemon in the back: ([('weak1', #), ...], [('strong1', #), ...])
+        Note: every candidate has the same weight
+        """
+        # Relations are rows of the league model's bool arrays, so the
+        # candidates below are column tests instead of list scans
+        model = self.league_model
+        row = self.species_index.get(pokemon)
+        if row is None:
+            countered = np.zeros(0, dtype=np.intp)
+        else:
+            countered = np.flatnonzero(model.counter_relation[:, row])
 
         # Find pokemon that the given pokemon counters
-        counters = [p for p, counters in self.species_counters_dict.items() if pokemon in counters]
+        counters = [self.species_ids[n] for n in countered]
         print(f"Pokemon that {pokemon} counters: {counters}")
 
-        # Find a pokemon weak to the countered pokemon
-        all_weak_pokemon = [weak_pokemon for counter in counters for weak_pokemon in self.species_counters_dict[counter]]
+        # Type weaknesses are compared through the TeamCreater's weakness bitmasks
+        tc = TeamCreater(self)
+        shared = tc.shares_weaknesses(self.species_ids, pokemon)
+        others = np.ones(len(self.species_ids), dtype=bool)
+        if row is not None:
+            others[row] = False
 
+        # Find pokemon weak to the countered pokemon
         # Only keep pokemon with different weaknesses
-        weak_kept_pokemon = []
-        for p in set(all_weak_pokemon):
-            pokemon_weaknesses = tc.get_weaknesses(p)
-            if len(set(pokemon_weaknesses.keys()) - set(ss_type_weaknesses.keys())) == len(pokemon_weaknesses):
-                weak_kept_pokemon.append(p)
-        
-        weaknesses_count = {p:weak_kept_pokemon.count(p)**2 for p in weak_kept_pokemon if p != pokemon}# {'p1': 1, 'p2':2, ...}
-        weaknesses_count_list = sorted(weaknesses_count.items(), key=lambda x: x[1], reverse=True)# [(p1, 5), (p2, 4),...]
+        weak = model.counter_relation[countered].any(axis=0)
+        weak_kept = np.flatnonzero(weak & ~shared & others)
+        weaknesses_count_list = self.count_list(weak_kept)# [(p1, 1), (p2, 1),...]
         print(f"Pokemon weak to the counters: {weaknesses_count_list}")
-        random_weak_pokemon = random.choices([w[0] for w in weaknesses_count_list], weights=[w[1] for w in weaknesses_count_list], k=1)[0]
-        print(f"Random chosen weak pokemon: {random_weak_pokemon}")
 
         # Find another pokemon strong against counters
-        all_strong_pokemon = [strong_pokemon for counter in counters for strong_pokemon in self.species_weaknesses_dict[counter]]
-        print(all_strong_pokemon)
-
         # Only keep pokmeon with similar weaknesses
-        strong_kept_pokemon = []
-        for p in set(all_strong_pokemon):
-            pokemon_weaknesses = tc.get_weaknesses(p)
-            if len(set(pokemon_weaknesses.keys()) - set(ss_type_weaknesses.keys())) != len(pokemon_weaknesses):
-                strong_kept_pokemon.append(p)
-
-        strong_count = {p:strong_kept_pokemon.count(p)**2 for p in strong_kept_pokemon if p != pokemon}
-        strong_count_list = sorted(strong_count.items(), key=lambda x:x[1], reverse=True)
+        strong = model.weakness_relation[countered].any(axis=0)
+        strong_kept = np.flatnonzero(strong & shared & others)
+        strong_count_list = self.count_list(strong_kept)
         print(f"Pokemon strong against countered pokemon: {strong_count_list}")
 
         # Only use top 25% of strong list
         #strong_count_list = strong_count_list[:len(strong_count_list)//4]
-        
+        return weaknesses_count_list, strong_count_list
+
+    def count_list(self, rows):
+        """
+        Returns [(p1, 1), (p2, 1), ...] of the species rows in row order.
+        Each pokemon is only counted once, like the set() of candidates it replaced.
+        """
+        return [(self.species_ids[n], 1) for n in rows]
+
+    def build_safeswap_team(self, pokemon):
+        """
+        Builds a team with the given pokemon in the back
+        """
+        weaknesses_count_list, strong_count_list = self.safeswap_candidates(pokemon)
+        random_weak_pokemon = random.choices([w[0] for w in weaknesses_count_list], weights=[w[1] for w in weaknesses_count_list], k=1)[0]
+        print(f"Random chosen weak pokemon: {random_weak_pokemon}")
+
         random_strong_pokemon = random.choices([w[0] for w in strong_count_list], weights=[w[1] for w in strong_count_list], k=1)[0]
         print(f"Random chosen strong pokemon: {random_strong_pokemon}")
 
@@ -501,18 +672,32 @@ class MetaTeamDestroyer:
         team_ivs = []
         print(f"Full team:")
         for p in pokemon_team:
-            print(f"    {p}: {self.species_moveset_dict[p]}")
-            results = f"{results}\n{p}\t{self.species_moveset_dict[p]}"
+            moveset = list(self.species_moveset_dict.get(p, ()))
+            print(f"    {p}: {moveset}")
+            results = f"{results}\n{p}\t{moveset}"
             team_ivs.append(self.get_default_ivs(p, self.league))
 
         return results, pokemon_team
 
+    def back_candidates(self, pokemon):
+        """
+        Returns the recommended counters to the lead's counters that don't
+        share a type weakness with it: [('p1', %), ('p2', %), ...]
+        """
+        lead_counters_list = [(c, 1) for c in self.get_counters(pokemon)]
+        counter_counters = self.get_reccommended_counters(lead_counters_list)
+
+        # Remove pokemon with similar weaknesses
+        tc = TeamCreater(self)
+        shared = tc.shares_weaknesses([counter[0] for counter in counter_counters], pokemon)
+        return [counter for counter, share in zip(counter_counters, shared) if not share]
+
     def build_team_from_pokemon(self, pokemon):
         """
         Builds a team with the given pokemon by choosing counters to it's weaknesses       
         """
         print(f"Building a team around {pokemon}")
-        lead_weaknesses = self.species_counters_dict[pokemon]
+        lead_weaknesses = self.get_counters(pokemon)
 
         # Determine pokemon weakness typings
         tc = TeamCreater(self)
@@ -521,18 +706,8 @@ class MetaTeamDestroyer:
         #print(f"Weaknesses of {pokemon}: {lead_weaknesses}")
 
         print("Making counters to the lead weaknesses")
-        lead_counters_list = [(c, 1) for c in lead_weaknesses]
-        counter_counters = self.get_reccommended_counters(lead_counters_list)
+        counter_counters = self.back_candidates(pokemon)
 
-        # Remove pokemon with similar weaknesses
-        removed_counters = []
-        for counter in counter_counters:
-            pokemon_weaknesses = tc.get_weaknesses(counter[0])
-            if len(set(pokemon_weaknesses.keys()) - set(lead_type_weaknesses.keys())) != len(pokemon_weaknesses):
-                #print(f"Should skip {counter} with weaknesses: {pokemon_weaknesses}")
-                removed_counters.append(counter[0])
-        counter_counters = [counter for counter in counter_counters if counter[0] not in removed_counters]
-        
         # need to pick one at a time so there are no repeats      
         back_pokemon1 = self.choose_weighted_pokemon(counter_counters)[0]
         index = [p[0] for p in counter_counters].index(back_pokemon1)
@@ -545,6 +720,102 @@ class MetaTeamDestroyer:
         return self.team_results(pokemon_team, pokemon)
 
 
+class MetaByRating:
+    """
+    Meta lists and recommended counters of every rating at once for one
+    days_back window, so switching or comparing ratings never rebuilds anything.
+
+    All of the window's counts come from the MetaAggregates in one lookup
+    and the counters of every (rating, position) are one matrix product.
+    """
+    def __init__(self, team_maker, days_back=None):
+        """
+        :param team_maker: The team maker of the league
+        :type team_maker: MetaTeamDestroyer
+        :param days_back: The number of days back to get data (Default: None)
+        :type days_back: int
+        """
+        self.league = team_maker.league
+        self.days_back = days_back
+        store = team_maker.aggregates.store
+
+        # Row 0 is all ratings together, then one row per rating
+        self.ratings = [None] + [int(r) for r in team_maker.aggregates.ratings]
+        self.rating_rows = {rating: n for n, rating in enumerate(self.ratings)}
+        counts, first_rows = team_maker.aggregates.rating_counts(days_back)
+        counts = np.concatenate([counts.sum(axis=0, keepdims=True), counts])
+        first_rows = np.concatenate([first_rows.min(axis=0, keepdims=True), first_rows])
+
+        # Remove pokemon not in the top TOP_PERCENT
+        if TOP_PERCENT:
+            min_allowed = TOP_PERCENT/100.0 * counts.sum(axis=-1, keepdims=True)
+            counts = np.where(counts > min_allowed, counts, 0)
+
+        # [(species, # of times reported), ...] of each rating and position
+        self.meta = []
+        for row_counts, row_first_rows in zip(counts, first_rows):
+            meta_lists = []
+            for position in [LEAD, SAFESWAP, BACK]:
+                species = np.flatnonzero(row_counts[position])
+                order = np.lexsort((row_first_rows[position][species], -row_counts[position][species]))
+                meta_lists.append([(store.species_ids[species[n]], int(row_counts[position][species[n]])) for n in order])
+            self.meta.append(meta_lists)
+        if TOP_TEAM_NUM:
+            # Only focus on top pokemon
+            counts = np.zeros_like(counts)
+            for n, meta_lists in enumerate(self.meta):
+                for position, meta_list in enumerate(meta_lists):
+                    for species_id, count in meta_list[:TOP_TEAM_NUM]:
+                        counts[n, position, store.species_index[species_id]] = count
+
+        # Counters of every rating and position: reported frequencies @ counter_matrix
+        # (same float32 sums and float64 percents as get_reccommended_counters)
+        store_to_model = np.zeros((len(store.species_ids), len(team_maker.species_ids)), dtype=np.float32)
+        for n, species_id in enumerate(store.species_ids):
+            row = team_maker.species_index.get(species_id)
+            if row is not None:
+                store_to_model[n, row] = 1
+        frequencies = counts.astype(np.float32) @ store_to_model
+        counter_totals = frequencies @ team_maker.counter_matrix
+        totals = counts.sum(axis=-1, keepdims=True).astype(np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.counter_percents = 100.*counter_totals.astype(np.float64) / totals
+        self.species_ids = team_maker.species_ids
+        self._counters = {}
+
+    def row(self, rating):
+        """ Returns the row of the rating (rounded to the nearest 100) or None """
+        return self.rating_rows.get(round_rating(rating))
+
+    def meta_lists(self, rating=None):
+        """
+        Returns the (leads, safe swaps, backs) lists at the rating
+        """
+        row = self.row(rating)
+        if row is None or not self.meta[row][LEAD]:
+            raise NoPokemonFound(
+                f"Did not find {self.league} data last {self.days_back} days at {round_rating(rating) or 'all'} rating"
+            )
+        return [list(meta_list) for meta_list in self.meta[row]]
+
+    def counters(self, rating, position):
+        """
+        Returns the recommended counters to the meta pokemon at the rating
+        and position: [('p1', %), ('p2', %), ...] like get_reccommended_counters
+        """
+        row = self.row(rating)
+        if row is None:
+            return []
+        counters = self._counters.get((row, position))
+        if counters is None:
+            percents = self.counter_percents[row, position]
+            species = np.flatnonzero(percents > 0)
+            order = np.argsort(-percents[species], kind='stable')
+            counters = [(self.species_ids[species[n]], float(percents[species[n]])) for n in order]
+            self._counters[(row, position)] = counters
+        return list(counters)
+
+
 def pretty_print_counters(counter_list, min_counters=None, use_percent=True):
     """ Prints the counters list nicely """
     return_text = ""
@@ -564,40 +835,53 @@ def pretty_print_counters(counter_list, min_counters=None, use_percent=True):
     print()
     return return_text
 
-def get_counters_for_rating(rating, league="ULP", days_back=None):
-    """ Prints the lead, safe swap, and back line counters at the given rating """
+def get_counters_for_rating(rating, league="ULP", days_back=None, team_maker=None):
+    """
+    Prints the lead, safe swap, and back line counters at the given rating.
+    Reuses the data of team_maker (if given) when it is for the league and not stale.
+    """
     if league not in LEAGUE_RANKINGS:
         return f"Did not find league '{league}'"
 
-    team_maker = MetaTeamDestroyer(rating=rating, league=league, days_back=days_back)
+    reuse = team_maker is not None and team_maker.league == league and not team_maker.is_stale()
+    count_cache("team_maker", reuse)
+    if reuse:
+        team_maker = team_maker.meta_view(rating=rating, days_back=days_back)
+    else:
+        with span("team_maker"):
+            team_maker = MetaTeamDestroyer(rating=rating, league=league, days_back=days_back)
     #creator = TeamCreater(team_maker)
     #creator.get_weaknesses('bulbasaur')
     #creator.get_weaknesses('swampert')
 
-    print(f"---------- Counters at {rating or 'all'} rating---------")
-    print("Leads:")
-    lead_counters = team_maker.get_reccommended_counters(team_maker.leads_list)
-    lead_counter_text = pretty_print_counters(lead_counters, MIN_COUNTERS)
+    # The counters of every rating were worked out with the meta lists
+    meta = team_maker.meta_by_rating(days_back)
+    with span("counters"):
+        print(f"---------- Counters at {rating or 'all'} rating---------")
+        print("Leads:")
+        lead_counters = meta.counters(rating, LEAD)
+        lead_counter_text = pretty_print_counters(lead_counters, MIN_COUNTERS)
 
-    print("\nCurrent Meta Leads:")
-    lead_text = pretty_print_counters(team_maker.leads_list, use_percent=False)
+        print("\nCurrent Meta Leads:")
+        lead_text = pretty_print_counters(team_maker.leads_list, use_percent=False)
 
-    print("-----\nSafe swaps")
-    ss_counters = team_maker.get_reccommended_counters(team_maker.safeswaps_list)
-    ss_counter_text = pretty_print_counters(ss_counters, MIN_COUNTERS)
+        print("-----\nSafe swaps")
+        ss_counters = meta.counters(rating, SAFESWAP)
+        ss_counter_text = pretty_print_counters(ss_counters, MIN_COUNTERS)
 
 
-    print("\nCurrent Meta SS:")
-    ss_text = pretty_print_counters(team_maker.safeswaps_list, use_percent=False)
+        print("\nCurrent Meta SS:")
+        ss_text = pretty_print_counters(team_maker.safeswaps_list, use_percent=False)
     
-    print("-----\nBack:")
-    back_counters = team_maker.get_reccommended_counters(team_maker.backs_list)
-    back_counter_text = pretty_print_counters(back_counters, MIN_COUNTERS)
+        print("-----\nBack:")
+        back_counters = meta.counters(rating, BACK)
+        back_counter_text = pretty_print_counters(back_counters, MIN_COUNTERS)
 
-    print("\nCurrent Meta Back:")
-    back_text = pretty_print_counters(team_maker.backs_list, use_percent=False)
+        print("\nCurrent Meta Back:")
+        back_text = pretty_print_counters(team_maker.backs_list, use_percent=False)
 
-    team_maker.recommend_team()
+    with span("recommend_team"):
+        team_maker.recommend_team()
 
     team_maker.result_data = {
         "good_leads": lead_counters,
@@ -0,0 +1,251 @@
+"""
+Weighted sampling of distinct teams
+
+recommend_team picks a team with a few weighted random choices. Drawing many
+teams that way re-sorts the weights on every choice and throws away the
+repeats. Here each distribution is turned into a Vose alias table once, so
+every draw is O(1), and a TeamSampler hands out N distinct teams in one go:
+
+  - When there are many more possible teams than requested, draws are made
+    in batches and repeats are skipped.
+  - Otherwise every possible team is listed with its probability and N are
+    sampled without replacement.
+
+Either way the teams follow the same distribution as repeatedly calling
+recommend_team and skipping repeats.
+"""
+
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+
+# Batches of draws made before falling back to listing every team
+MAX_DRAW_ROUNDS = 20
+
+
+class AliasTable:
+    """
+    Vose's alias method: O(n) setup then O(1) weighted draws
+    """
+    def __init__(self, weights):
+        """
+        :param weights: The non negative weight of each item
+        :type weights: array-like
+        """
+        weights = np.asarray(weights, dtype=np.float64)
+        n = len(weights)
+        self.probability = np.ones(n)
+        self.alias = np.arange(n)
+        if n == 0:
+            return
+
+        scaled = weights * n / weights.sum()
+        small = [i for i in range(n) if scaled[i] < 1.0]
+        large = [i for i in range(n) if scaled[i] >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.probability[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] = scaled[more] + scaled[less] - 1.0
+            (small if scaled[more] < 1.0 else large).append(more)
+        # Whatever is left is 1 up to rounding error
+        for i in small + large:
+            self.probability[i] = 1.0
+
+    def __len__(self):
+        return len(self.alias)
+
+    def draw(self, rng, size):
+        """ Returns size random item indexes """
+        columns = rng.integers(0, len(self.alias), size=size)
+        keep = rng.random(size) < self.probability[columns]
+        return np.where(keep, columns, self.alias[columns])
+
+
+def sample_without_replacement(weights, k, rng):
+    """
+    Returns the indexes of k items drawn one after another without
+    replacement, each with probability proportional to its weight
+    (Efraimidis-Spirakis keys)
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    keys = np.log(rng.random(len(weights))) / weights
+    return np.argsort(-keys, kind='stable')[:k]
+
+
+class PairSampler:
+    """
+    Draws an unordered pair of items as two weighted picks without replacement,
+    where each pick only uses the preferred items while any are left
+    (like recommend_team choosing two back pokemon).
+    """
+    def __init__(self, weights, preferred):
+        """
+        :param weights: The weight of each item
+        :type weights: array-like
+        :param preferred: Which items are picked while any are left
+        :type preferred: array-like of bool
+        """
+        self.weights = np.asarray(weights, dtype=np.float64)
+        preferred = np.asarray(preferred, dtype=bool)
+        if not preferred.any():
+            preferred = np.ones(len(self.weights), dtype=bool)
+
+        self.preferred = np.flatnonzero(preferred)
+        if len(self.preferred) == 1:
+            # The only preferred item is always picked first, the second
+            # pick is from everything else
+            self.first = self.preferred[0]
+            self.others = np.flatnonzero(np.arange(len(self.weights)) != self.first)
+            self.table = AliasTable(self.weights[self.others])
+        else:
+            self.first = None
+            self.table = AliasTable(self.weights[self.preferred])
+
+    def count(self):
+        """ Returns the number of distinct pairs that can be drawn """
+        if self.first is not None:
+            return len(self.others)
+        return len(self.preferred) * (len(self.preferred) - 1) // 2
+
+    def draw(self, rng, size):
+        """ Returns two arrays with the item indexes of size random pairs """
+        if self.first is not None:
+            return np.full(size, self.first), self.others[self.table.draw(rng, size)]
+
+        first = self.table.draw(rng, size)
+        second = self.table.draw(rng, size)
+        for _ in range(MAX_DRAW_ROUNDS):
+            repeats = np.flatnonzero(first == second)
+            if not len(repeats):
+                break
+            second[repeats] = self.table.draw(rng, len(repeats))
+        else:
+            # A dominant item keeps being drawn twice; pick from the rest directly
+            weights = self.weights[self.preferred]
+            for n in np.flatnonzero(first == second):
+                rest = weights.copy()
+                rest[first[n]] = 0
+                second[n] = rng.choice(len(rest), p=rest / rest.sum())
+        return self.preferred[first], self.preferred[second]
+
+    def pairs(self):
+        """ Returns the item indexes (a, b) and the probability of every pair """
+        if self.first is not None:
+            weights = self.weights[self.others]
+            return np.full(len(self.others), self.first), self.others, weights / weights.sum()
+
+        weights = self.weights[self.preferred]
+        total = weights.sum()
+        a, b = np.triu_indices(len(weights), k=1)
+        probability = weights[a] * weights[b] / total * (1 / (total - weights[a]) + 1 / (total - weights[b]))
+        return self.preferred[a], self.preferred[b], probability
+
+
+class TeamSampler(ABC):
+    """
+    Samples distinct teams from a team distribution.
+    Subclasses define count(), draw() and teams().
+    """
+    @abstractmethod
+    def count(self):
+        """ Returns the number of distinct teams that can be drawn """
+
+    @abstractmethod
+    def draw(self, rng, size):
+        """ Returns size random teams (tuples of species ids) """
+
+    @abstractmethod
+    def teams(self):
+        """ Returns every possible team and its probability """
+
+    def sample(self, n, rng):
+        """
+        Returns min(n, count()) distinct random teams in the order drawn
+        """
+        possible = self.count()
+        if possible > 2 * n:
+            chosen = {}
+            for _ in range(MAX_DRAW_ROUNDS):
+                for team in self.draw(rng, 2 * (n - len(chosen))):
+                    chosen.setdefault(team, None)
+                    if len(chosen) == n:
+                        return list(chosen)
+
+        # Few possible teams (or a very skewed distribution): list them all
+        teams, probability = self.teams()
+        return [teams[i] for i in sample_without_replacement(probability, min(n, possible), rng)]
+
+
+class LeadTeamSampler(TeamSampler):
+    """
+    Teams of a weighted random lead and two weighted random back pokemon
+    picked for that lead: (lead, *sorted(backs))
+    """
+    def __init__(self, leads, lead_weights, backs):
+        """
+        :param leads: The lead species ids
+        :type leads: list
+        :param lead_weights: The weight of each lead
+        :type lead_weights: list
+        :param backs: The back species ids and PairSampler of each lead
+        :type backs: list
+        """
+        self.leads = leads
+        self.lead_weights = np.asarray(lead_weights, dtype=np.float64)
+        self.backs = backs
+        self.table = AliasTable(self.lead_weights)
+
+    def count(self):
+        return sum([pair_sampler.count() for _, pair_sampler in self.backs])
+
+    def draw(self, rng, size):
+        lead_rows = self.table.draw(rng, size)
+        teams = []
+        for row, lead_count in zip(*np.unique(lead_rows, return_counts=True)):
+            names, pair_sampler = self.backs[row]
+            for a, b in zip(*pair_sampler.draw(rng, lead_count)):
+                teams.append((self.leads[row],) + tuple(sorted([names[a], names[b]])))
+        rng.shuffle(teams)
+        return teams
+
+    def teams(self):
+        teams, probability = [], []
+        lead_probability = self.lead_weights / self.lead_weights.sum()
+        for lead, (names, pair_sampler), p_lead in zip(self.leads, self.backs, lead_probability):
+            first, second, p_pair = pair_sampler.pairs()
+            teams.extend([(lead,) + tuple(sorted([names[a], names[b]])) for a, b in zip(first, second)])
+            probability.append(p_lead * p_pair)
+        return teams, np.concatenate(probability) if probability else np.zeros(0)
+
+
+class SafeswapTeamSampler(TeamSampler):
+    """
+    Teams of a weighted random pokemon, the chosen safe swap and another
+    weighted random pokemon: (weak, chosen, strong)
+    """
+    def __init__(self, chosen, weak, weak_weights, strong, strong_weights):
+        self.chosen = chosen
+        self.weak, self.strong = weak, strong
+        self.weak_weights = np.asarray(weak_weights, dtype=np.float64)
+        self.strong_weights = np.asarray(strong_weights, dtype=np.float64)
+        self.weak_table = AliasTable(self.weak_weights)
+        self.strong_table = AliasTable(self.strong_weights)
+
+    def count(self):
+        return len(self.weak) * len(self.strong)
+
+    def draw(self, rng, size):
+        weak_rows = self.weak_table.draw(rng, size)
+        strong_rows = self.strong_table.draw(rng, size)
+        return [(self.weak[w], self.chosen, self.strong[s]) for w, s in zip(weak_rows, strong_rows)]
+
+    def teams(self):
+        if not self.count():
+            return [], np.zeros(0)
+        weak_rows, strong_rows = np.divmod(np.arange(self.count()), len(self.strong))
+        probability = (
+            self.weak_weights[weak_rows] / self.weak_weights.sum() * self.strong_weights[strong_rows] / self.strong_weights.sum()
+        )
+        return [(self.weak[w], self.chosen, self.strong[s]) for w, s in zip(weak_rows, strong_rows)], probability
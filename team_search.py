@@ -0,0 +1,156 @@
+"""
+Search for the teams that handle the most of the meta
+
+A team is a lead and two back pokemon (the safe swap and the closer). It is
+scored by:
+
+  - the share of the weighted meta (leads, safe swaps and backs) that at
+    least one team member counters,
+  - plus LEAD_WEIGHT times the share of the meta leads the lead counters,
+  - minus WEAKNESS_PENALTY for every type that two or more members are weak to.
+
+Which meta pokemon each candidate counters is kept as a packed bitset, so a
+team's coverage is an OR of three rows and its weighted size is a sum of
+per-byte lookup tables. Leads are searched best first (keeping the best
+beam_width, or all of them), and back pairs are skipped as soon as their
+best possible score can't reach the current top-K.
+"""
+
+import heapq
+
+import numpy as np
+
+
+LEAD_WEIGHT = 0.5
+WEAKNESS_PENALTY = 0.05
+BEAM_WIDTH = 32
+
+# Number of set bits in every byte value
+_POPCOUNT = np.array([bin(n).count('1') for n in range(256)], dtype=np.int64)
+# Bits of every byte value in np.packbits order (most significant first)
+_BYTE_BITS = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).astype(np.float64)
+
+
+def popcount(values):
+    """ Returns the number of set bits of each uint32 value """
+    values = np.ascontiguousarray(values, dtype=np.uint32)
+    return _POPCOUNT[values.view(np.uint8)].reshape(values.shape + (4,)).sum(axis=-1)
+
+
+def byte_tables(weights):
+    """
+    Returns the (n_bytes, 256) table of the summed weights of the bits set
+    in each byte value at each byte of a packed bitset
+    """
+    n_bytes = (len(weights) + 7) // 8
+    padded = np.zeros(n_bytes * 8)
+    padded[:len(weights)] = weights
+    return (_BYTE_BITS @ padded.reshape(n_bytes, 8).T).T
+
+
+class TeamSearch:
+    """
+    Top-K team search over the candidates' packed meta coverage
+    """
+    def __init__(self, candidates, covers, meta_weights, lead_weights, weakness_masks, safeswap_weights=None):
+        """
+        :param candidates: The species ids that can be on a team
+        :type candidates: list
+        :param covers: (candidates, meta) bools of which meta pokemon each candidate counters
+        :type covers: numpy.ndarray
+        :param meta_weights: The weight of each meta pokemon (sums to 1)
+        :type meta_weights: numpy.ndarray
+        :param lead_weights: The weight of each meta pokemon as a lead (sums to 1)
+        :type lead_weights: numpy.ndarray
+        :param weakness_masks: The type weakness bitmask of each candidate
+        :type weakness_masks: numpy.ndarray
+        :param safeswap_weights: The weight of each meta pokemon as a safe swap, used to
+                                 pick which back pokemon is the safe swap (Default: None)
+        :type safeswap_weights: numpy.ndarray
+        """
+        self.candidates = list(candidates)
+        self.bits = np.packbits(np.asarray(covers, dtype=bool), axis=1)
+        self.meta_table = byte_tables(meta_weights)
+        self.masks = np.asarray(weakness_masks, dtype=np.uint32)
+        self.byte_index = np.arange(self.bits.shape[1])
+
+        # Score of every candidate as a lead on its own
+        self.coverage = self.weighted(self.bits, self.meta_table)
+        self.lead_scores = self.coverage + LEAD_WEIGHT * self.weighted(self.bits, byte_tables(lead_weights))
+        if safeswap_weights is None:
+            self.safeswap_coverage = np.zeros(len(self.candidates))
+        else:
+            self.safeswap_coverage = self.weighted(self.bits, byte_tables(safeswap_weights))
+
+    def weighted(self, bits, table):
+        """ Returns the summed weights of the bits set in each packed row """
+        if not bits.shape[-1]:
+            return np.zeros(bits.shape[:-1])
+        return table[self.byte_index, bits].sum(axis=-1)
+
+    def search(self, k, beam_width=BEAM_WIDTH, leads=None):
+        """
+        Returns the k best (score, (lead, safe swap, back)) teams, best first.
+        The back pokemon countering more of the meta safe swaps is the safe swap.
+
+        :param k: The number of teams
+        :type k: int
+        :param beam_width: The number of best leads searched (Default: BEAM_WIDTH, None for all)
+        :type beam_width: int
+        :param leads: Only search teams with these leads (Default: all candidates)
+        :type leads: list
+        """
+        if leads is None:
+            lead_rows = np.arange(len(self.candidates))
+        else:
+            index = {species_id: n for n, species_id in enumerate(self.candidates)}
+            lead_rows = np.array([index[p] for p in leads if p in index], dtype=np.intp)
+        lead_rows = lead_rows[np.argsort(-self.lead_scores[lead_rows], kind='stable')]
+        if beam_width:
+            lead_rows = lead_rows[:beam_width]
+
+        best = []# min-heap of (score, -found, team)
+        found = 0
+        for lead in lead_rows:
+            union = self.bits[lead] | self.bits
+            gains = self.weighted(union, self.meta_table) - self.coverage[lead]
+            gains[lead] = -np.inf
+            order = np.argsort(-gains, kind='stable')[:-1]
+            if len(order) < 2:
+                continue
+
+            # Adding a member never gains more than it does on its own
+            if len(best) == k and self.lead_scores[lead] + gains[order[0]] + gains[order[1]] <= best[0][0]:
+                continue
+
+            lead_mask = self.masks[lead]
+            for n, back in enumerate(order[:-1]):
+                others = order[n + 1:]
+                if len(best) == k and self.lead_scores[lead] + gains[back] + gains[others[0]] <= best[0][0]:
+                    break
+
+                coverage = self.weighted(union[back] | self.bits[others], self.meta_table)
+                masks = self.masks[others]
+                shared = (lead_mask & self.masks[back]) | ((lead_mask | self.masks[back]) & masks)
+                scores = self.lead_scores[lead] + coverage - self.coverage[lead] - WEAKNESS_PENALTY * popcount(shared)
+
+                if len(best) == k:
+                    keep = np.flatnonzero(scores > best[0][0])
+                else:
+                    keep = np.arange(len(scores))
+                for m in keep[np.argsort(-scores[keep], kind='stable')]:
+                    if len(best) == k and scores[m] <= best[0][0]:
+                        break
+                    item = (float(scores[m]), -found, (lead, back, others[m]))
+                    found += 1
+                    if len(best) < k:
+                        heapq.heappush(best, item)
+                    else:
+                        heapq.heapreplace(best, item)
+
+        teams = []
+        for score, _, (lead, back1, back2) in sorted(best, reverse=True):
+            if self.safeswap_coverage[back2] > self.safeswap_coverage[back1]:
+                back1, back2 = back2, back1
+            teams.append((score, (self.candidates[lead], self.candidates[back1], self.candidates[back2])))
+        return teams